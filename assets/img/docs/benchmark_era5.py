@@ -0,0 +1,459 @@
+""" Benchmarks the weather extraction and capacity models of extract_solar.py and extract_wind.py.
+
+Synthetic ERA5 files with the layout of get_era5.py (14 monthly files per variable,
+from December of the previous year to January of the next year) are written for a
+grid of the given size. The benchmark then times and memory-profiles each stage
+separately on a set of random sites:
+
+- Extraction: create_weather_batch reading the weather of all sites
+- Solar model: the NumPy engine of create_solar on the extracted weather
+- Wind model: the NumPy engine of create_wind on the extracted weather
+- Solar and wind end to end: create_solar and create_wind, including extraction
+
+Each stage is also checked against a reference: xarray for the extraction, and the
+per-site gsee and windpowerlib models for the capacity factors. Everything runs
+offline.
+
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import extract_solar
+import extract_wind
+
+# Variables read by create_solar and create_wind, as file prefix: ERA5 variable
+SOLAR_VARIABLES = {
+    "global_horizontal": "msdwswrf",  # W/m^2
+    "direct_shortwave": "msdrswrf",  # W/m^2
+    "2m_temperature": "t2m",  # K
+}
+WIND_VARIABLES = {
+    "100uwind": "u100",  # m/s
+    "100vwind": "v100",  # m/s
+    "10uwind": "u10",  # m/s
+    "10vwind": "v10",  # m/s
+    "roughness_length": "fsr",  # m
+    "pressure": "sp",  # Pa
+    "2m_temperature": "t2m",  # K
+}
+# Column names expected by the capacity models
+SOLAR_COLUMNS = {
+    "msdwswrf": "global_horizontal",
+    "msdrswrf": "direct_shortwave",
+    "t2m": "temperature",
+}
+WIND_COLUMNS = {
+    "u100": "100uwind",
+    "v100": "100vwind",
+    "u10": "10uwind",
+    "v10": "10vwind",
+    "fsr": "roughness_length",
+    "sp": "pressure",
+    "t2m": "temperature",
+}
+
+
+def synthetic_field(
+    varname: str,
+    times: pd.DatetimeIndex,
+    latitudes: np.ndarray,
+    longitudes: np.ndarray,
+    rng: np.random.Generator,
+) -> np.ndarray:
+    """Return a (time x latitude x longitude) field with plausible values of an ERA5 variable.
+
+    Args:
+        varname (str): ERA5 variable name, e.g. 'msdwswrf'
+        times (pd.DatetimeIndex): Hourly UTC times
+        latitudes (np.ndarray): Latitudes of the grid
+        longitudes (np.ndarray): Longitudes of the grid
+        rng (np.random.Generator): Source of the random noise
+
+    Returns:
+        np.ndarray: Values of the field as float32
+    """
+    shape = (len(times), len(latitudes), len(longitudes))
+    if varname in ("msdwswrf", "msdrswrf"):
+        # Daily cycle following the local solar time
+        solar_hour = times.hour.values[:, None, None] + longitudes[None, None, :] / 15
+        clear_sky = np.clip(1000 * np.sin((solar_hour - 6) / 12 * np.pi), 0, None)
+        cloudiness = rng.random(shape)
+        values = clear_sky * (1 - 0.7 * cloudiness)
+        if varname == "msdrswrf":
+            values = values * (1 - cloudiness)
+    elif varname == "t2m":
+        values = 295 + 8 * rng.random(shape)
+    elif varname in ("u100", "v100"):
+        values = 8 * rng.standard_normal(shape)
+    elif varname in ("u10", "v10"):
+        values = 5 * rng.standard_normal(shape)
+    elif varname == "fsr":
+        values = 0.05 + 0.2 * rng.random(shape)
+    elif varname == "sp":
+        values = 100000 + 1000 * rng.random(shape)
+    else:
+        raise ValueError(f"No synthetic field for the ERA5 variable: {varname}")
+    return values.astype(np.float32)
+
+
+def write_synthetic_era5(
+    folder: str,
+    descriptive_to_era5: dict[str, str],
+    year: int,
+    bbox: dict[str, float],
+    resolution: float = 0.25,
+    seed: int = 0,
+) -> None:
+    """Write synthetic monthly ERA5 files in the layout of get_era5.py.
+
+    Files that already exist are kept, so a benchmark can reuse the data of a previous run.
+
+    Args:
+        folder (str): Folder of the files
+        descriptive_to_era5 (dict[str, str]): Mapping of file prefixes to ERA5 variable names
+        year (int): Year of the data
+        bbox (dict[str, float]): Bounding box of the grid, see get_era5.get_bbox
+        resolution (float, optional): Grid spacing in degrees. Defaults to 0.25
+        seed (int, optional): Seed of the random values. Defaults to 0
+    """
+    os.makedirs(folder, exist_ok=True)
+    # ERA5 latitudes are in descending order
+    latitudes = np.arange(
+        bbox["max_lat"], bbox["min_lat"] - resolution / 2, -resolution
+    )
+    longitudes = np.arange(
+        bbox["min_lon"], bbox["max_lon"] + resolution / 2, resolution
+    )
+    month_starts = pd.date_range(f"{year - 1}-12-01", periods=15, freq="MS")
+
+    for key, varname in descriptive_to_era5.items():
+        for month in range(14):
+            filename = f"{folder}/{key}_{month:02d}.nc"
+            if os.path.exists(filename):
+                continue
+            times = pd.date_range(
+                month_starts[month], month_starts[month + 1], freq="h", inclusive="left"
+            )
+            # Each file has its own noise, so the files can be written in any order
+            rng = np.random.default_rng([seed, month, sum(map(ord, varname))])
+            values = synthetic_field(varname, times, latitudes, longitudes, rng)
+            dataset = xr.Dataset(
+                {varname: (("valid_time", "latitude", "longitude"), values)},
+                coords={
+                    "valid_time": times,
+                    "latitude": latitudes,
+                    "longitude": longitudes,
+                },
+            )
+            dataset.to_netcdf(filename)
+
+
+def synthetic_sites(
+    n_sites: int, bbox: dict[str, float], prefix: str, seed: int = 0
+) -> pd.DataFrame:
+    """Return random sites inside the bounding box.
+
+    Args:
+        n_sites (int): Number of sites
+        bbox (dict[str, float]): Bounding box of the grid, see get_era5.get_bbox
+        prefix (str): Prefix of the site names, e.g. 's' for solar sites
+        seed (int, optional): Seed of the random sites. Defaults to 0
+
+    Returns:
+        pd.DataFrame: Sites with columns 'name', 'max_capacity', 'latitude' and 'longitude'
+    """
+    rng = np.random.default_rng([seed, ord(prefix[0])])
+    return pd.DataFrame(
+        {
+            "name": [f"{prefix}{i}" for i in range(n_sites)],
+            "max_capacity": rng.integers(1, 100, n_sites),
+            "latitude": np.round(
+                rng.uniform(bbox["min_lat"], bbox["max_lat"], n_sites), 4
+            ),
+            "longitude": np.round(
+                rng.uniform(bbox["min_lon"], bbox["max_lon"], n_sites), 4
+            ),
+        }
+    )
+
+
+def measure(function: Callable, *args, profile_memory: bool = True, **kwargs) -> dict:
+    """Time a function and measure the peak memory it allocates.
+
+    The memory is measured in a second run with tracemalloc, which slows Python
+    code down, so that it does not affect the time.
+
+    Args:
+        function (Callable): Function to benchmark
+        *args: Arguments of the function
+        profile_memory (bool, optional): Measure the peak memory. Defaults to True
+        **kwargs: Keyword arguments of the function
+
+    Returns:
+        dict: 'result' of the function, 'seconds' and 'peak_mib' (NaN without profile_memory)
+    """
+    start_time = time.perf_counter()
+    result = function(*args, **kwargs)
+    seconds = time.perf_counter() - start_time
+
+    peak_mib = np.nan
+    if profile_memory:
+        tracemalloc.start()
+        try:
+            function(*args, **kwargs)
+            peak_mib = tracemalloc.get_traced_memory()[1] / 2**20
+        finally:
+            tracemalloc.stop()
+    return {"result": result, "seconds": seconds, "peak_mib": peak_mib}
+
+
+def reference_weather(
+    data_folder: str,
+    descriptive_to_era5: dict[str, str],
+    latitudes: np.ndarray,
+    longitudes: np.ndarray,
+    start: str,
+    end: str,
+    timezone: str = "Asia/Bangkok",
+) -> dict[str, np.ndarray]:
+    """Read the weather of each site with xarray, as a reference for create_weather_batch.
+
+    Args:
+        data_folder (str): Folder of the monthly ERA5 files
+        descriptive_to_era5 (dict[str, str]): Mapping of file prefixes to ERA5 variable names
+        latitudes (np.ndarray): Latitude of each site
+        longitudes (np.ndarray): Longitude of each site
+        start (str): First local time of the period
+        end (str): End (exclusive) of the local period
+        timezone (str, optional): Timezone of the period. Defaults to "Asia/Bangkok"
+
+    Returns:
+        dict[str, np.ndarray]: A (time x site) array for each ERA5 variable
+    """
+    utc_start = pd.Timestamp(start, tz=timezone).tz_convert("UTC").tz_localize(None)
+    utc_end = pd.Timestamp(end, tz=timezone).tz_convert("UTC").tz_localize(None)
+    # Index the sites as points instead of the outer product of their coordinates
+    points = {
+        "latitude": xr.DataArray(latitudes, dims="site"),
+        "longitude": xr.DataArray(longitudes, dims="site"),
+    }
+
+    weather = {}
+    for key, varname in descriptive_to_era5.items():
+        parts = []
+        for month in range(14):
+            with xr.open_dataset(f"{data_folder}/{key}_{month:02d}.nc") as dataset:
+                parts.append(dataset[varname].sel(points, method="nearest").load())
+        series = xr.concat(parts, dim="valid_time")
+        series = series.sel(valid_time=slice(utc_start, utc_end))
+        times = pd.DatetimeIndex(series["valid_time"].values)
+        weather[varname] = series.values[times < utc_end]
+    return weather
+
+
+def max_difference(values: np.ndarray, reference: np.ndarray) -> float:
+    """Return the largest absolute difference between two arrays of the same shape"""
+    if values.shape != reference.shape:
+        raise ValueError(f"Shapes differ: {values.shape} and {reference.shape}")
+    return float(np.max(np.abs(values - reference), initial=0))
+
+
+def benchmark(
+    n_sites: int,
+    data_folder: str,
+    year: int,
+    bbox: dict[str, float],
+    reference_sites: int = 5,
+    profile_memory: bool = True,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """Benchmark every stage on synthetic sites and check it against its reference.
+
+    Args:
+        n_sites (int): Number of solar sites, and of wind sites
+        data_folder (str): Folder with the 'solar_data' and 'wind_data' of write_synthetic_era5
+        year (int): Year to compute
+        bbox (dict[str, float]): Bounding box of the synthetic grid
+        reference_sites (int, optional): Number of sites checked against the per-site
+            reference models, which are slow. Defaults to 5
+        profile_memory (bool, optional): Measure the peak memory of each stage. Defaults to True
+        seed (int, optional): Seed of the random sites. Defaults to 0
+
+    Returns:
+        pd.DataFrame: 'seconds' and 'peak_mib' of each stage, the 'reference_seconds' of its
+            reference on the checked sites, the 'max_difference' from it and whether it is 'equivalent'
+    """
+    start, end = f"{year}-01-01", f"{year + 1}-01-01"
+    solar_folder = f"{data_folder}/solar_data"
+    wind_folder = f"{data_folder}/wind_data"
+    solar_df = synthetic_sites(n_sites, bbox, "s", seed)
+    wind_df = synthetic_sites(n_sites, bbox, "w", seed)
+    checked = np.arange(min(reference_sites, n_sites))
+    results = {}
+
+    def record(
+        stage: str, run: dict, reference: dict, difference: float, tolerance: float
+    ) -> None:
+        results[stage] = {
+            "seconds": run["seconds"],
+            "peak_mib": run["peak_mib"],
+            "reference_seconds": reference["seconds"],
+            "max_difference": difference,
+            "equivalent": difference <= tolerance,
+        }
+        print(f"{stage}: {run['seconds']:.2f} s, max difference {difference:.2g}")
+
+    # Extraction
+    weather = {}
+    for technology, folder, sites_df, descriptive_to_era5, columns in (
+        ("solar", solar_folder, solar_df, SOLAR_VARIABLES, SOLAR_COLUMNS),
+        ("wind", wind_folder, wind_df, WIND_VARIABLES, WIND_COLUMNS),
+    ):
+        latitudes = sites_df["latitude"].values
+        longitudes = sites_df["longitude"].values
+        run = measure(
+            extract_solar.create_weather_batch,
+            descriptive_to_era5,
+            latitudes,
+            longitudes,
+            folder,
+            start=start,
+            end=end,
+            profile_memory=profile_memory,
+        )
+        reference = measure(
+            reference_weather,
+            folder,
+            descriptive_to_era5,
+            latitudes,
+            longitudes,
+            start,
+            end,
+            profile_memory=False,
+        )
+        difference = max(
+            max_difference(series.to_numpy(), reference["result"][varname])
+            for varname, series in run["result"].items()
+        )
+        record(f"extract {technology} weather", run, reference, difference, 0)
+        weather[technology] = {
+            columns[varname]: series for varname, series in run["result"].items()
+        }
+
+    # Solar model, with the default PV system of create_solar
+    pv_system = extract_solar.DEFAULT_PV_SYSTEM
+    solar_args = [
+        (
+            latitude,
+            longitude,
+            pv_system["tilt"],
+            pv_system["azim"],
+            pv_system["tracking"],
+        )
+        for latitude, longitude in zip(solar_df["latitude"], solar_df["longitude"])
+    ]
+    run = measure(
+        extract_solar._solar_factors,
+        weather["solar"],
+        solar_args,
+        profile_memory=profile_memory,
+    )
+    reference = measure(
+        lambda: np.column_stack(
+            [
+                extract_solar._solar_factor(
+                    extract_solar.site_weather_data(weather["solar"], site),
+                    *solar_args[site],
+                )
+                for site in checked
+            ]
+        ),
+        profile_memory=False,
+    )
+    # GSEE keeps part of the irradiance in float32, see _solar_factors
+    difference = max_difference(run["result"][:, checked], reference["result"])
+    record("solar model", run, reference, difference, 1e-6)
+
+    # Wind model, with the default turbine of create_wind
+    turbine = extract_wind.get_turbine(**extract_wind.DEFAULT_TURBINE)
+    run = measure(
+        extract_wind._wind_factors,
+        weather["wind"],
+        [(turbine,)] * n_sites,
+        profile_memory=profile_memory,
+    )
+    reference = measure(
+        lambda: np.column_stack(
+            [
+                extract_wind._wind_factor(
+                    extract_solar.site_weather_data(weather["wind"], site), turbine
+                )
+                for site in checked
+            ]
+        ),
+        profile_memory=False,
+    )
+    difference = max_difference(run["result"][:, checked], reference["result"])
+    record("wind model", run, reference, difference, 0)
+
+    # End to end, against the per-site engines on the checked sites
+    for technology, create_capacity, folder, sites_df, reference_engine in (
+        ("solar", extract_solar.create_solar, solar_folder, solar_df, "gsee"),
+        ("wind", extract_wind.create_wind, wind_folder, wind_df, "windpowerlib"),
+    ):
+        run = measure(
+            create_capacity,
+            sites_df,
+            folder,
+            start=start,
+            end=end,
+            profile_memory=profile_memory,
+        )
+        reference = measure(
+            create_capacity,
+            sites_df.iloc[checked],
+            folder,
+            start=start,
+            end=end,
+            engine=reference_engine,
+            profile_memory=False,
+        )
+        # Capacities are rounded to 4 decimals
+        difference = max_difference(
+            run["result"].iloc[:, checked].to_numpy(), reference["result"].to_numpy()
+        )
+        record(f"create_{technology}", run, reference, difference, 1e-4 + 1e-9)
+
+    return pd.DataFrame.from_dict(results, orient="index")
+
+
+if __name__ == "__main__":
+    # Size of the synthetic grid, in 0.25 degree cells
+    bbox = {"min_lat": 10.0, "max_lat": 15.0, "min_lon": 99.0, "max_lon": 104.0}
+    year = 2023
+    site_counts = [10, 100]
+    # Keep the synthetic files between runs by setting a folder
+    data_folder = None
+
+    folder = data_folder or tempfile.mkdtemp(prefix="era5_benchmark_")
+    try:
+        write_synthetic_era5(f"{folder}/solar_data", SOLAR_VARIABLES, year, bbox)
+        write_synthetic_era5(f"{folder}/wind_data", WIND_VARIABLES, year, bbox)
+        for n_sites in site_counts:
+            print(f"Benchmarking {n_sites} sites")
+            summary = benchmark(n_sites, folder, year, bbox)
+            print(summary.to_string(float_format="{:.4g}".format))
+            if not summary["equivalent"].all():
+                raise AssertionError("Results differ from the reference implementation")
+    finally:
+        if data_folder is None:
+            shutil.rmtree(folder)
@@ -12,21 +12,542 @@ We can calculate the diffuse fraction as follows:
 
 """
 
+from __future__ import annotations
+
+import concurrent.futures
+import datetime
+import functools
+import glob
+import json
+import multiprocessing
+import os
+import queue
+import threading
+from contextlib import ExitStack
+from multiprocessing.shared_memory import SharedMemory
+from typing import TYPE_CHECKING, Callable
+
+import numpy as np
 import xarray as xr
 import pandas as pd
 import geopandas as gpd
+import ephem
 import gsee
+import factor_cache
 from nearest_point import assign_nearest_substation
 
+if TYPE_CHECKING:
+    import pyarrow as pa
+
+# PV system of the sites without 'tilt', 'azim' or 'tracking'
+DEFAULT_PV_SYSTEM = {
+    "tilt": 35,  # degrees
+    "azim": 180,  # degrees, 180 faces the equator
+    "tracking": 0,  # 0 (none), 1 (1-axis) or 2 (2-axis)
+}
+
+# Sun position computed by GSEE for each location
+SUN_ANGLES = ("sun_alt", "sun_azimuth", "sun_zenith", "duration")
+
+# Sites (or groups) per batch, so the weather of the next batch is read while
+# the model runs on the current one
+BATCH_SIZE = 256
+
 
 def load_era5_timeseries(
     filename: str, varname: str, latitude: float, longitude: float
+) -> pd.Series:
+    """Load the ERA5 timeseries data from a NetCDF file and return a Series
+    with the variable name as the name."""
+    times, values = read_era5_points([filename], varname, [latitude], [longitude])
+    return pd.Series(values[:, 0], index=times, name=varname)
+
+
+def _time_slice(
+    times: np.ndarray, start: pd.Timestamp | None, end: pd.Timestamp | None
+) -> slice:
+    """Return the positions of sorted `times` within [start, end). None is unbounded."""
+    first = 0 if start is None else np.searchsorted(times, np.datetime64(start))
+    last = len(times) if end is None else np.searchsorted(times, np.datetime64(end))
+    return slice(first, last)
+
+
+def _grid_indices(
+    dataset: xr.Dataset, latitudes: np.ndarray, longitudes: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Return the positions of the nearest grid cell of each point in the 1-D coordinates.
+
+    This is the same nearest-neighbour lookup as Dataset.sel(method="nearest").
+    """
+    lat_idx = dataset.indexes["latitude"].get_indexer(
+        np.asarray(latitudes), method="nearest"
+    )
+    lon_idx = dataset.indexes["longitude"].get_indexer(
+        np.asarray(longitudes), method="nearest"
+    )
+    return lat_idx, lon_idx
+
+
+def read_era5_points(
+    filenames: list[str],
+    varname: str,
+    latitudes: np.ndarray,
+    longitudes: np.ndarray,
+    start: pd.Timestamp | None = None,
+    end: pd.Timestamp | None = None,
+) -> tuple[pd.DatetimeIndex, np.ndarray]:
+    """Read the ERA5 timeseries of many points from a list of NetCDF files into NumPy.
+
+    The nearest grid cells are found once from the 1-D coordinates and reused by
+    every file on the same grid. Each file is read as one hyperslab covering the
+    cells of all points, and the points are picked from it with NumPy indexing.
+
+    Args:
+        filenames (list[str]): NetCDF files to read, in chronological order
+        varname (str): ERA5 variable name, e.g. 't2m'
+        latitudes (np.ndarray): Latitude of each point
+        longitudes (np.ndarray): Longitude of each point
+        start (pd.Timestamp, optional): First time to load in UTC. Defaults to None
+        end (pd.Timestamp, optional): Load times before this one in UTC. Defaults to None
+
+    Returns:
+        tuple[pd.DatetimeIndex, np.ndarray]: Times in UTC, and a (time x point) array
+        with the points ordered as the input coordinates
+    """
+    grid = None
+    with ExitStack() as stack:
+        # Files are opened lazily so the output can be sized before reading values
+        slabs = []
+        for filename in filenames:
+            dataset = stack.enter_context(xr.open_dataset(filename))
+            variable = dataset[varname].transpose(..., "latitude", "longitude")
+            # Older files use "time" while newer CDS files use "valid_time"
+            time_dim = variable.dims[0]
+            time_slice = _time_slice(dataset[time_dim].values, start, end)
+            if time_slice.stop <= time_slice.start:
+                # Files outside the requested period are not read
+                continue
+
+            coords = (dataset["latitude"].values, dataset["longitude"].values)
+            if grid is None or not all(map(np.array_equal, grid, coords)):
+                grid = coords
+                lat_idx, lon_idx = _grid_indices(dataset, latitudes, longitudes)
+                # Smallest block of cells that holds every point
+                lat_block = slice(lat_idx.min(), lat_idx.max() + 1)
+                lon_block = slice(lon_idx.min(), lon_idx.max() + 1)
+                lat_pos, lon_pos = lat_idx - lat_block.start, lon_idx - lon_block.start
+            slabs.append(
+                (
+                    variable[time_slice, lat_block, lon_block],
+                    dataset[time_dim].values[time_slice],
+                    lat_pos,
+                    lon_pos,
+                )
+            )
+        if not slabs:
+            raise ValueError(f"No {varname} data between {start} and {end}")
+
+        # Write each file into its slice of a single preallocated array
+        n_times = sum(len(times) for _, times, _, _ in slabs)
+        values = np.empty((n_times, len(lat_pos)), dtype=slabs[0][0].dtype)
+        row = 0
+        for slab, times, lat_pos, lon_pos in slabs:
+            values[row : row + len(times)] = slab.values[:, lat_pos, lon_pos]
+            row += len(times)
+        times = pd.DatetimeIndex(
+            np.concatenate([times for _, times, _, _ in slabs]), name=time_dim
+        )
+
+    return times, values
+
+
+def load_era5_points(
+    filenames: list[str],
+    varname: str,
+    latitudes: np.ndarray,
+    longitudes: np.ndarray,
+    start: pd.Timestamp | None = None,
+    end: pd.Timestamp | None = None,
 ) -> pd.DataFrame:
-    """Load the ERA5 timeseries data from a NetCDF file and return a DataFrame
-    with the variable name as the column name."""
-    dataset = xr.open_dataset(filename)
-    dataset = dataset.sel(longitude=longitude, latitude=latitude, method="nearest")
-    return dataset.to_dataframe()[varname]
+    """Load the ERA5 timeseries of many points from a list of NetCDF files.
+
+    Each file is opened and read once for all points by read_era5_points, so the
+    cost grows with the number of files instead of the number of points.
+
+    Args:
+        filenames (list[str]): NetCDF files to read, in chronological order
+        varname (str): ERA5 variable name, e.g. 't2m'
+        latitudes (np.ndarray): Latitude of each point
+        longitudes (np.ndarray): Longitude of each point
+        start (pd.Timestamp, optional): First time to load in UTC. Defaults to None
+        end (pd.Timestamp, optional): Load times before this one in UTC. Defaults to None
+
+    Returns:
+        pd.DataFrame: Timeseries with time as the index and one column per point,
+        ordered as the input coordinates
+    """
+    times, values = read_era5_points(
+        filenames, varname, latitudes, longitudes, start, end
+    )
+    return pd.DataFrame(values, index=times)
+
+
+def load_era5_store(
+    filename: str,
+    varname: str,
+    latitudes: np.ndarray,
+    longitudes: np.ndarray,
+    start: pd.Timestamp | None = None,
+    end: pd.Timestamp | None = None,
+) -> pd.DataFrame:
+    """Load the ERA5 timeseries of many points from a file written by get_era5.rechunk_data.
+
+    The file stores the full timeseries of each grid cell as one chunk, so each
+    distinct grid cell is read with a single chunk read.
+
+    Args:
+        filename (str): Merged NetCDF file of a variable
+        varname (str): ERA5 variable name, e.g. 't2m'
+        latitudes (np.ndarray): Latitude of each point
+        longitudes (np.ndarray): Longitude of each point
+        start (pd.Timestamp, optional): First time to load in UTC. Defaults to None
+        end (pd.Timestamp, optional): Load times before this one in UTC. Defaults to None
+
+    Returns:
+        pd.DataFrame: Timeseries with time as the index and one column per point,
+        ordered as the input coordinates
+    """
+    with xr.open_dataset(filename) as dataset:
+        lat_idx, lon_idx = _grid_indices(dataset, latitudes, longitudes)
+        variable = dataset[varname].transpose(..., "latitude", "longitude")
+        time_dim = variable.dims[0]
+        variable = variable.isel(
+            {time_dim: _time_slice(variable[time_dim].values, start, end)}
+        )
+
+        values = np.empty((variable.shape[0], len(lat_idx)), dtype=variable.dtype)
+        # Read each grid cell once and copy it to the other points in the cell
+        first_point = {}
+        for point, cell in enumerate(zip(lat_idx, lon_idx)):
+            if cell in first_point:
+                values[:, point] = values[:, first_point[cell]]
+            else:
+                values[:, point] = variable[:, cell[0], cell[1]].values
+                first_point[cell] = point
+        times = variable[time_dim].values
+
+    return pd.DataFrame(values, index=pd.Index(times, name=time_dim))
+
+
+def _store_covers(
+    filename: str, start: pd.Timestamp | None, end: pd.Timestamp | None
+) -> bool:
+    """Return whether a merged file written by get_era5.rechunk_data covers [start, end)"""
+    if start is None and end is None:
+        return True
+    with xr.open_dataset(filename) as dataset:
+        time_dim = "valid_time" if "valid_time" in dataset.dims else "time"
+        times = pd.DatetimeIndex(dataset[time_dim].values)
+    if len(times) == 0:
+        return False
+    # The last value covers one time step
+    step = times[1] - times[0] if len(times) > 1 else pd.Timedelta(hours=1)
+    return (start is None or times[0] <= start) and (
+        end is None or times[-1] + step >= end
+    )
+
+
+def _store_matches(filename: str, monthly_files: list[str]) -> bool:
+    """Return whether the monthly files left next to a merged file are the ones it was made from"""
+    existing = [monthly for monthly in monthly_files if os.path.exists(monthly)]
+    if not existing:
+        return True
+    with xr.open_dataset(filename) as dataset:
+        # Record of the monthly files, see get_era5.INPUTS_ATTRIBUTE
+        inputs = json.loads(dataset.attrs.get("era5_inputs", "{}"))
+    return factor_cache.inputs_match(inputs, existing)
+
+
+def era5_files(
+    data_folder: str,
+    key: str,
+    start: pd.Timestamp | None = None,
+    end: pd.Timestamp | None = None,
+) -> list[str]:
+    """Return the ERA5 files of a variable in chronological order.
+
+    This is the merged file written by get_era5.rechunk_data if it exists,
+    matches the monthly files it was made from and covers [start, end) in UTC,
+    otherwise the monthly files that overlap the period. Monthly files are either
+    the 14 files of one year written by get_era5 or the year-month files of the
+    multi-year cache written by get_era5.get_era5_years.
+    """
+    # 14 months with two extra months: Dec (indexed as 00) of the previous year
+    # and Jan (indexed as 13) of the next year
+    months = [f"{i:02d}" for i in range(0, 14)]
+    filenames = [f"{data_folder}/{key}_{month}.nc" for month in months]
+
+    store = f"{data_folder}/{key}.nc"
+    if os.path.exists(store):
+        if not _store_matches(store, filenames):
+            if not all(map(os.path.exists, filenames)):
+                raise ValueError(
+                    f"ERA5 file {store} does not match the monthly files of {key}"
+                )
+            print(
+                f"Monthly files of {key} changed since {store} was merged. Reading "
+                "the monthly files; run get_era5.rechunk_data to merge them again."
+            )
+        elif _store_covers(store, start, end):
+            return [store]
+
+    # Year-month files of the multi-year cache, e.g. '2m_temperature_2019_12.nc'
+    pattern = (
+        glob.escape(f"{data_folder}/{key}") + "_[0-9][0-9][0-9][0-9]_[0-9][0-9].nc"
+    )
+    cached = sorted(glob.glob(pattern))
+    if cached:
+        return _cached_files(cached, start, end)
+    if os.path.exists(store) and not all(map(os.path.exists, filenames)):
+        raise ValueError(f"ERA5 file {store} does not cover {start} to {end}")
+    if start is None and end is None:
+        return filenames
+
+    # The downloaded year is the year of month 01
+    with xr.open_dataset(filenames[1]) as dataset:
+        time_dim = "valid_time" if "valid_time" in dataset.dims else "time"
+        year = pd.Timestamp(dataset[time_dim].values[0]).year
+    month_starts = pd.date_range(f"{year - 1}-12-01", periods=15, freq="MS")
+    # A period past the downloaded months would silently be cut short
+    if (start is not None and start < month_starts[0]) or (
+        end is not None and end > month_starts[-1]
+    ):
+        raise ValueError(f"ERA5 files of {year} do not cover {start} to {end}")
+    return [
+        filename
+        for filename, month_start, month_end in zip(
+            filenames, month_starts[:-1], month_starts[1:]
+        )
+        if (start is None or month_end > start) and (end is None or month_start < end)
+    ]
+
+
+def era5_folders(data_folder: str) -> list[str]:
+    """Return the folders of the ERA5 boxes downloaded by get_era5.get_era5_boxes.
+
+    The boxes are the subfolders 'box_0', 'box_1', ... of `data_folder`. A folder
+    downloaded with a single bounding box is its own only box.
+    """
+    boxes = [
+        name
+        for name in os.listdir(data_folder)
+        if name.startswith("box_") and os.path.isdir(os.path.join(data_folder, name))
+    ]
+    if not boxes:
+        return [data_folder]
+    return [
+        os.path.join(data_folder, name)
+        for name in sorted(boxes, key=lambda name: int(name[len("box_") :]))
+    ]
+
+
+def assign_era5_folders(
+    folders: list[str], key: str, latitudes: np.ndarray, longitudes: np.ndarray
+) -> np.ndarray:
+    """Return the position in `folders` of the box that covers each site.
+
+    A box covers a site if the nearest grid cell of the site is inside the box, so
+    reading the site from the box gives the same cell as reading it from one large
+    box. The first covering box is used when boxes overlap.
+
+    Args:
+        folders (list[str]): Folders returned by era5_folders
+        key (str): File prefix of any ERA5 variable
+        latitudes (np.ndarray): Latitude of each site
+        longitudes (np.ndarray): Longitude of each site
+
+    Returns:
+        np.ndarray: Folder position of each site
+    """
+    latitudes = np.asarray(latitudes)
+    longitudes = np.asarray(longitudes)
+    site_folders = np.full(len(latitudes), -1)
+    if len(folders) == 1:
+        site_folders[:] = 0
+        return site_folders
+
+    for position, folder in enumerate(folders):
+        with xr.open_dataset(era5_files(folder, key)[0]) as dataset:
+            grid_latitudes = dataset["latitude"].values
+            grid_longitudes = dataset["longitude"].values
+        # Half a grid cell around the box still has its nearest cell in the box
+        lat_margin = np.abs(np.diff(grid_latitudes)).min(initial=0.25) / 2
+        lon_margin = np.abs(np.diff(grid_longitudes)).min(initial=0.25) / 2
+        covered = (
+            (site_folders == -1)
+            & (latitudes >= grid_latitudes.min() - lat_margin)
+            & (latitudes <= grid_latitudes.max() + lat_margin)
+            & (longitudes >= grid_longitudes.min() - lon_margin)
+            & (longitudes <= grid_longitudes.max() + lon_margin)
+        )
+        site_folders[covered] = position
+
+    if (site_folders == -1).any():
+        missing = np.flatnonzero(site_folders == -1)
+        raise ValueError(
+            f"No ERA5 box covers the sites at positions {missing.tolist()}"
+        )
+    return site_folders
+
+
+def _cached_files(
+    filenames: list[str], start: pd.Timestamp | None, end: pd.Timestamp | None
+) -> list[str]:
+    """Select the year-month files of the multi-year cache that overlap [start, end)"""
+    selected = []
+    for filename in filenames:
+        year, month = filename[-len("YYYY_MM.nc") : -len(".nc")].split("_")
+        month_start = pd.Timestamp(f"{year}-{month}-01")
+        month_end = month_start + pd.offsets.MonthBegin()
+        if (start is None or month_end > start) and (end is None or month_start < end):
+            selected.append((month_start, month_end, filename))
+    if not selected:
+        raise ValueError(f"No cached ERA5 files overlap {start} to {end}")
+
+    # A missing month would silently leave a gap in the timeseries
+    for (_, previous_end, _), (month_start, _, filename) in zip(
+        selected[:-1], selected[1:]
+    ):
+        if month_start != previous_end:
+            raise ValueError(f"ERA5 cache is missing the months before {filename}")
+    if (start is not None and selected[0][0] > start) or (
+        end is not None and selected[-1][1] < end
+    ):
+        raise ValueError(f"ERA5 cache does not cover {start} to {end}")
+    return [filename for _, _, filename in selected]
+
+
+def era5_inputs(
+    data_folder: str,
+    keys: list[str],
+    start: str | pd.Timestamp | None = None,
+    end: str | pd.Timestamp | None = None,
+) -> list[str]:
+    """Return every ERA5 file, over all boxes, that a local period can read.
+
+    The period is widened by a day on each side to cover any timezone. This is
+    the input of factor_cache.era5_fingerprint, so adding other months to a
+    multi-year cache does not invalidate cached factors.
+    """
+    margin = pd.Timedelta(days=1)
+    utc_start = (
+        None if start is None else pd.Timestamp(start).tz_localize(None) - margin
+    )
+    utc_end = None if end is None else pd.Timestamp(end).tz_localize(None) + margin
+    return [
+        file
+        for folder in era5_folders(data_folder)
+        for key in keys
+        for file in era5_files(folder, key, utc_start, utc_end)
+    ]
+
+
+def _to_utc(timestamp: str | pd.Timestamp | None, timezone: str) -> pd.Timestamp | None:
+    """Convert a timestamp to naive UTC as used by ERA5. Naive input is read in `timezone`."""
+    if timestamp is None:
+        return None
+    timestamp = pd.Timestamp(timestamp)
+    if timestamp.tz is None:
+        timestamp = timestamp.tz_localize(timezone)
+    return timestamp.tz_convert("UTC").tz_localize(None)
+
+
+def create_weather_batch(
+    descriptive_to_era5: dict[str, str],
+    latitudes: np.ndarray,
+    longitudes: np.ndarray,
+    data_folder: str,
+    timezone: str = "Asia/Bangkok",
+    start: str | pd.Timestamp | None = None,
+    end: str | pd.Timestamp | None = None,
+) -> dict[str, pd.DataFrame]:
+    """Create weather data of many sites for capacity calculation
+
+    Args:
+        descriptive_to_era5 (dict[str, str]): Mapping of file prefixes to ERA5 variable names
+        latitudes (np.ndarray): Latitude of each site
+        longitudes (np.ndarray): Longitude of each site
+        data_folder (str): Folder containing the merged or monthly ERA5 files, or their boxes
+        timezone (str, optional): Timezone of the output index. Defaults to "Asia/Bangkok"
+        start (str | pd.Timestamp, optional): First time of the period in `timezone`,
+            e.g. '2023-01-01'. Defaults to None, which starts with the first file
+        end (str | pd.Timestamp, optional): End of the period (exclusive) in `timezone`,
+            e.g. '2024-01-01'. Defaults to None, which ends with the last file
+
+    Returns:
+        dict[str, pd.DataFrame]: A (time x site) DataFrame for each ERA5 variable
+    """
+    # ERA5 is in UTC, so the local period is shifted by the timezone offset
+    utc_start = _to_utc(start, timezone)
+    utc_end = _to_utc(end, timezone)
+
+    # Sites of dispersed portfolios are read from the box that covers them
+    latitudes = np.asarray(latitudes)
+    longitudes = np.asarray(longitudes)
+    folders = era5_folders(data_folder)
+    site_folders = assign_era5_folders(
+        folders, next(iter(descriptive_to_era5)), latitudes, longitudes
+    )
+
+    weather = {}
+    for key, value in descriptive_to_era5.items():
+        parts = []
+        for position, folder in enumerate(folders):
+            sites = np.flatnonzero(site_folders == position)
+            if len(sites) == 0:
+                continue
+            filenames = era5_files(folder, key, utc_start, utc_end)
+            if filenames == [f"{folder}/{key}.nc"]:
+                # Merged file written by get_era5.rechunk_data
+                part = load_era5_store(
+                    filenames[0],
+                    value,
+                    latitudes[sites],
+                    longitudes[sites],
+                    utc_start,
+                    utc_end,
+                )
+            else:
+                part = load_era5_points(
+                    filenames,
+                    value,
+                    latitudes[sites],
+                    longitudes[sites],
+                    utc_start,
+                    utc_end,
+                )
+            parts.append((sites, part))
+
+        if len(parts) == 1:
+            series = parts[0][1]
+        else:
+            # Place the columns of each box at the positions of its sites
+            first = parts[0][1]
+            values = np.empty((len(first), len(latitudes)), dtype=first.values.dtype)
+            for sites, part in parts:
+                values[:, sites] = part.values
+            series = pd.DataFrame(values, index=first.index)
+        # Convert index to datetime in the local timezone
+        series.index = pd.to_datetime(series.index, utc=True).tz_convert(timezone)
+        weather[value] = series
+    return weather
+
+
+def site_weather_data(weather: dict[str, pd.DataFrame], position: int) -> pd.DataFrame:
+    """Return the weather data of a single site from the output of create_weather_batch"""
+    return pd.DataFrame(
+        {varname: series.iloc[:, position] for varname, series in weather.items()}
+    )
 
 
 def create_weather_data(
@@ -35,39 +556,732 @@ def create_weather_data(
     longitude: float,
     data_folder: str,
     timezone: str = "Asia/Bangkok",
+    start: str | pd.Timestamp | None = None,
+    end: str | pd.Timestamp | None = None,
 ) -> pd.DataFrame:
     """Create weather data for capacity calculation"""
-    # 14 months with two extra months: Dec (indexed as 00) of the previous year
-    # and Jan (indexed as 13) of the next year
-    months = [f"{i:02d}" for i in range(0, 14)]
+    weather = create_weather_batch(
+        descriptive_to_era5,
+        latitudes=[latitude],
+        longitudes=[longitude],
+        data_folder=data_folder,
+        timezone=timezone,
+        start=start,
+        end=end,
+    )
+    return site_weather_data(weather, 0)
 
-    output = pd.DataFrame()
-    for key, value in descriptive_to_era5.items():
-        series = pd.DataFrame()
-        for month in months:
-            filename = f"{data_folder}/{key}_{month}.nc"
-            dataset = load_era5_timeseries(
-                filename, value, latitude=latitude, longitude=longitude
+
+def assign_grid_cells(
+    filename: str, latitudes: np.ndarray, longitudes: np.ndarray
+) -> pd.DataFrame:
+    """Return the coordinates of the nearest ERA5 grid cell of each site
+
+    Args:
+        filename (str): Any NetCDF file of the ERA5 grid
+        latitudes (np.ndarray): Latitude of each site
+        longitudes (np.ndarray): Longitude of each site
+
+    Returns:
+        pd.DataFrame: Columns 'latitude' and 'longitude' of the grid cells, ordered as the sites
+    """
+    with xr.open_dataset(filename) as dataset:
+        grid_latitudes = dataset["latitude"].sel(
+            latitude=np.asarray(latitudes), method="nearest"
+        )
+        grid_longitudes = dataset["longitude"].sel(
+            longitude=np.asarray(longitudes), method="nearest"
+        )
+        return pd.DataFrame(
+            {"latitude": grid_latitudes.values, "longitude": grid_longitudes.values}
+        )
+
+
+def site_grid_cells(
+    data_folder: str, key: str, latitudes: np.ndarray, longitudes: np.ndarray
+) -> pd.DataFrame:
+    """Return the coordinates of the nearest ERA5 grid cell of each site, over all boxes
+
+    Args:
+        data_folder (str): Folder containing the ERA5 files, or their boxes
+        key (str): File prefix of any ERA5 variable
+        latitudes (np.ndarray): Latitude of each site
+        longitudes (np.ndarray): Longitude of each site
+
+    Returns:
+        pd.DataFrame: Columns 'latitude' and 'longitude' of the grid cells, ordered as the sites
+    """
+    latitudes = np.asarray(latitudes)
+    longitudes = np.asarray(longitudes)
+    folders = era5_folders(data_folder)
+    site_folders = assign_era5_folders(folders, key, latitudes, longitudes)
+
+    cells = pd.DataFrame(
+        {"latitude": np.nan, "longitude": np.nan}, index=range(len(latitudes))
+    )
+    for position, folder in enumerate(folders):
+        sites = np.flatnonzero(site_folders == position)
+        if len(sites) == 0:
+            continue
+        folder_cells = assign_grid_cells(
+            era5_files(folder, key)[0], latitudes[sites], longitudes[sites]
+        )
+        cells.iloc[sites] = folder_cells.values
+    return cells
+
+
+def group_sites(cells: pd.DataFrame, parameters: pd.DataFrame) -> np.ndarray:
+    """Label sites that share the same grid cell and model parameters
+
+    Args:
+        cells (pd.DataFrame): Grid cell of each site as returned by assign_grid_cells
+        parameters (pd.DataFrame): Model parameters of each site, one column per parameter
+
+    Returns:
+        np.ndarray: Group label of each site. Labels are numbered in order of first appearance.
+    """
+    keys = pd.concat(
+        [cells.reset_index(drop=True), parameters.reset_index(drop=True)], axis=1
+    )
+    return keys.groupby(list(keys.columns), sort=False).ngroup().values
+
+
+def group_members(site_groups: np.ndarray, n_groups: int) -> list[np.ndarray]:
+    """Return the positions of the sites of each group
+
+    Args:
+        site_groups (np.ndarray): Group label of each site as returned by group_sites
+        n_groups (int): Number of groups
+
+    Returns:
+        list[np.ndarray]: Sorted site positions of each group, indexed by group label
+    """
+    order = np.argsort(site_groups, kind="stable")
+    counts = np.bincount(site_groups, minlength=n_groups)
+    return np.split(order, np.cumsum(counts)[:-1])
+
+
+def _fill_site_capacity(
+    capacity: np.ndarray,
+    factor: np.ndarray,
+    members: np.ndarray,
+    max_capacities: np.ndarray,
+) -> None:
+    """Write the capacity of the sites of a group into their columns of `capacity`"""
+    capacity[:, members] = np.outer(factor, max_capacities[members])
+
+
+def _run_group_chunk(
+    group_model: Callable,
+    weather_specs: dict[str, tuple[str, tuple, str]],
+    time_index: pd.Index,
+    capacity_spec: tuple[str, tuple, str],
+    groups: np.ndarray,
+    group_args: list[tuple],
+    members: list[np.ndarray],
+    max_capacities: np.ndarray,
+) -> None:
+    """Run `group_model` for a chunk of groups inside a worker process.
+
+    The weather data and the capacity output are attached from shared memory
+    so only their names are sent to the worker.
+    """
+    handles = [SharedMemory(name=spec[0]) for spec in weather_specs.values()]
+    capacity_handle = SharedMemory(name=capacity_spec[0])
+    try:
+        weather = {
+            varname: np.ndarray(spec[1], dtype=spec[2], buffer=handle.buf)
+            for (varname, spec), handle in zip(weather_specs.items(), handles)
+        }
+        capacity = np.ndarray(
+            capacity_spec[1], dtype=capacity_spec[2], buffer=capacity_handle.buf
+        )
+        for group, group_sites in zip(groups, members):
+            weather_data = pd.DataFrame(
+                {varname: values[:, group] for varname, values in weather.items()},
+                index=time_index,
             )
-            # Append to the series
-            if series.empty:
-                series = dataset
+            factor = group_model(weather_data, *group_args[group])
+            _fill_site_capacity(capacity, factor, group_sites, max_capacities)
+    finally:
+        # Views into the buffers must be released before closing them
+        weather = capacity = None
+        for handle in handles + [capacity_handle]:
+            handle.close()
+
+
+def _process_pool(workers: int) -> concurrent.futures.ProcessPoolExecutor:
+    """Return a pool of `workers` processes that are not forked from this process.
+
+    Forking while another thread holds the netCDF or HDF5 locks, e.g. the reader
+    thread of prefetch_weather, can deadlock the workers. They are started by a
+    fork server instead, or spawned where it is not available.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+    else:
+        context = multiprocessing.get_context("spawn")
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, mp_context=context
+    )
+
+
+def run_site_groups(
+    group_model: Callable,
+    weather: dict[str, pd.DataFrame],
+    group_args: list[tuple],
+    site_groups: np.ndarray,
+    max_capacities: np.ndarray,
+    workers: int = 1,
+    executor: concurrent.futures.Executor | None = None,
+) -> np.ndarray:
+    """Run a capacity factor model for every group of sites and scale it to each site.
+
+    Args:
+        group_model (Callable): Function called as group_model(weather_data, *args) that
+            returns the capacity factor of a group. It must be defined at module level
+            so it can be sent to worker processes.
+        weather (dict[str, pd.DataFrame]): A (time x group) DataFrame for each weather variable
+        group_args (list[tuple]): Extra arguments of group_model for each group
+        site_groups (np.ndarray): Group label of each site
+        max_capacities (np.ndarray): Maximum capacity of each site
+        workers (int, optional): Number of worker processes. Defaults to 1, which runs serially
+        executor (concurrent.futures.Executor, optional): Pool of `workers` processes to
+            reuse across calls. Defaults to None, which starts one for this call
+
+    Returns:
+        np.ndarray: A (time x site) array of capacities, ordered as the sites
+    """
+    time_index = next(iter(weather.values())).index
+    capacity_shape = (len(time_index), len(site_groups))
+    members = group_members(site_groups, len(group_args))
+
+    if workers <= 1:
+        capacity = np.empty(capacity_shape)
+        for group, args in enumerate(group_args):
+            factor = group_model(site_weather_data(weather, group), *args)
+            _fill_site_capacity(capacity, factor, members[group], max_capacities)
+        return capacity
+
+    handles = []
+    try:
+        # Place the weather arrays in shared memory so workers do not pickle them
+        weather_specs = {}
+        for varname, series in weather.items():
+            values = series.to_numpy()
+            handle = SharedMemory(create=True, size=max(values.nbytes, 1))
+            handles.append(handle)
+            np.ndarray(values.shape, dtype=values.dtype, buffer=handle.buf)[:] = values
+            weather_specs[varname] = (handle.name, values.shape, values.dtype.str)
+
+        # Workers write into disjoint site columns of a shared output array
+        capacity_handle = SharedMemory(
+            create=True, size=max(int(np.prod(capacity_shape)) * 8, 1)
+        )
+        handles.append(capacity_handle)
+        capacity_spec = (capacity_handle.name, capacity_shape, np.dtype(float).str)
+
+        # Several chunks per worker to balance the load
+        chunks = np.array_split(
+            np.arange(len(group_args)), min(len(group_args), workers * 4)
+        )
+        with ExitStack() as stack:
+            if executor is None:
+                executor = stack.enter_context(_process_pool(workers))
+            futures = [
+                executor.submit(
+                    _run_group_chunk,
+                    group_model,
+                    weather_specs,
+                    time_index,
+                    capacity_spec,
+                    chunk,
+                    group_args,
+                    [members[group] for group in chunk],
+                    max_capacities,
+                )
+                for chunk in chunks
+            ]
+            # Raise the first error of any worker
+            for future in futures:
+                future.result()
+
+        return np.ndarray(
+            capacity_shape, dtype=float, buffer=capacity_handle.buf
+        ).copy()
+    finally:
+        for handle in handles:
+            handle.close()
+            handle.unlink()
+
+
+def prefetch_weather(
+    extract_weather: Callable[[np.ndarray], dict[str, pd.DataFrame]],
+    batches: list[np.ndarray],
+    depth: int = 2,
+):
+    """Yield (batch, weather) for each batch of groups while a background thread reads ahead.
+
+    The thread reads at most `depth` batches ahead of the consumer, so file reads
+    and decompression overlap with the model runs while memory stays bounded.
+
+    Args:
+        extract_weather (Callable): Function returning the weather data of the given groups
+        batches (list[np.ndarray]): Groups of each batch, in the order to yield them
+        depth (int, optional): Maximum number of batches read ahead. Defaults to 2
+    """
+    results = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        # Give up when the consumer has stopped, instead of blocking on a full queue
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read_batches() -> None:
+        try:
+            for batch in batches:
+                if not put((batch, extract_weather(batch))):
+                    return
+        except Exception as error:
+            put(error)
+            return
+        put(None)
+
+    reader = threading.Thread(target=read_batches, daemon=True)
+    reader.start()
+    try:
+        while (item := results.get()) is not None:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        reader.join()
+
+
+def _compute_factors(
+    group_model: Callable,
+    extract_weather: Callable[[np.ndarray], dict[str, pd.DataFrame]],
+    groups: np.ndarray,
+    group_args: list[tuple],
+    workers: int = 1,
+    batch_size: int | None = BATCH_SIZE,
+    vectorized: bool = False,
+) -> tuple[pd.Index, np.ndarray]:
+    """Compute the capacity factor of the given groups, one batch of groups at a time.
+
+    The weather of the next batches is read by prefetch_weather while the model
+    runs on the current batch, so reads only overlap with the model when there is
+    more than one batch. A vectorized model runs on a whole batch at once.
+
+    Returns:
+        tuple[pd.Index, np.ndarray]: Time index and (time x group) array of factors
+    """
+    batch_size = batch_size or len(groups)
+    batches = [groups[i : i + batch_size] for i in range(0, len(groups), batch_size)]
+
+    factors = None
+    column = 0
+    with ExitStack() as stack:
+        # One pool serves every batch, and is created before the reader thread starts
+        executor = None
+        if workers > 1:
+            executor = stack.enter_context(_process_pool(workers))
+        for batch, weather in prefetch_weather(extract_weather, batches):
+            batch_args = [group_args[group] for group in batch]
+            if vectorized:
+                batch_factors = group_model(weather, batch_args, executor=executor)
             else:
-                series = pd.concat([series, dataset], axis=0)
+                # Run each group as its own site with unit capacity to get its factor
+                batch_factors = run_site_groups(
+                    group_model,
+                    weather,
+                    batch_args,
+                    site_groups=np.arange(len(batch)),
+                    max_capacities=np.ones(len(batch)),
+                    workers=workers,
+                    executor=executor,
+                )
+            if factors is None:
+                time_index = next(iter(weather.values())).index
+                factors = np.empty((len(time_index), len(groups)))
+            factors[:, column : column + len(batch)] = batch_factors
+            column += len(batch)
+    return time_index, factors
+
 
-        if output.empty:
-            output = series
+def compute_capacity(
+    group_model: Callable,
+    extract_weather: Callable[[np.ndarray], dict[str, pd.DataFrame]],
+    group_args: list[tuple],
+    site_groups: np.ndarray,
+    max_capacities: np.ndarray,
+    workers: int = 1,
+    cache_folder: str | None = None,
+    group_keys: list[str] | None = None,
+    max_cache_bytes: int | None = None,
+    batch_size: int | None = BATCH_SIZE,
+    vectorized: bool = False,
+) -> tuple[pd.Index, np.ndarray]:
+    """Compute the capacity of every site, reusing cached factors when a cache is given.
+
+    Args:
+        group_model (Callable): Capacity factor model passed to run_site_groups
+        extract_weather (Callable): Function returning the weather data of the given groups
+        group_args (list[tuple]): Extra arguments of group_model for each group
+        site_groups (np.ndarray): Group label of each site
+        max_capacities (np.ndarray): Maximum capacity of each site
+        workers (int, optional): Number of worker processes. Defaults to 1
+        cache_folder (str, optional): Folder of the factor cache. Defaults to None, which disables caching
+        group_keys (list[str], optional): Cache key of each group. Required with `cache_folder`
+        max_cache_bytes (int, optional): Size limit of the cache. Defaults to None, which is unlimited
+        batch_size (int, optional): Number of groups per batch. The weather of the next batch
+            is read while the current batch runs. Defaults to BATCH_SIZE. None reads all groups
+            at once, without overlap
+        vectorized (bool, optional): group_model is called as group_model(weather, args, executor=executor)
+            with the weather and arguments of a whole batch, and returns a (time x group) array of
+            factors. `executor` is a pool of `workers` processes the model may use, or None with
+            one worker. Defaults to False
+
+    Returns:
+        tuple[pd.Index, np.ndarray]: Time index and (time x site) array of capacities
+    """
+    # Only groups that are not in the cache are extracted and computed
+    cached = {}
+    if cache_folder is not None:
+        cached = factor_cache.load_factors(cache_folder, group_keys)
+    missing = np.array([g for g in range(len(group_args)) if g not in cached], int)
+    if cache_folder is not None:
+        print(f"Capacity factors: {len(cached)} cached, {len(missing)} to compute")
+
+    if len(missing) > 0:
+        time_index, factors = _compute_factors(
+            group_model,
+            extract_weather,
+            missing,
+            group_args,
+            workers,
+            batch_size,
+            vectorized,
+        )
+        if cache_folder is not None:
+            for column, group in enumerate(missing):
+                factor = pd.Series(factors[:, column], index=time_index)
+                factor_cache.save_factor(cache_folder, group_keys[group], factor)
+    else:
+        time_index = next(iter(cached.values())).index
+
+    capacity = np.empty((len(time_index), len(site_groups)))
+    members = group_members(site_groups, len(group_args))
+    for column, group in enumerate(missing):
+        _fill_site_capacity(
+            capacity, factors[:, column], members[group], max_capacities
+        )
+    for group, factor in cached.items():
+        _fill_site_capacity(capacity, factor.to_numpy(), members[group], max_capacities)
+
+    if cache_folder is not None and max_cache_bytes is not None:
+        factor_cache.evict_cache(cache_folder, max_cache_bytes)
+    return time_index, capacity
+
+
+def _solar_factor(
+    weather_data: pd.DataFrame,
+    latitude: float,
+    longitude: float,
+    tilt: float,
+    azim: float,
+    tracking: int,
+) -> np.ndarray:
+    """Return the hourly solar factor of a 1 W PV system"""
+    weather_data = weather_data.copy()
+    # The GSEE package expects the temperature in Celsius
+    weather_data["temperature"] = weather_data["temperature"] - 273.15
+    # Calculate the diffuse fraction
+    weather_data["diffuse"] = (
+        weather_data["global_horizontal"] - weather_data["direct_shortwave"]
+    )
+    weather_data["diffuse_fraction"] = weather_data["diffuse"] / (
+        weather_data["global_horizontal"] + 0.0001
+    )
+
+    # The gsee.pv.run_model function expects the following columns:
+    # - temperature: Temperature in Celsius
+    # - global_horizontal: Total radiation in W/m^2
+    # - diffuse_fraction: Diffuse fraction
+    solar_factor = gsee.pv.run_model(
+        data=weather_data,
+        coords=(latitude, longitude),
+        tilt=tilt,
+        azim=azim,
+        tracking=tracking,
+        capacity=1,  # Use 1 W so we can scale it later
+    )
+    return solar_factor.values
+
+
+def _location_angles(
+    time_index: pd.DatetimeIndex, latitude: float, longitude: float
+) -> np.ndarray:
+    """Return the sun position of one location as a (time x angle) array, ordered as SUN_ANGLES.
+
+    Same ephem calls and result as gsee.trigon.sun_angles, without its pandas
+    lookup of the sunrise and sunset of every hour, which costs more than the sun
+    position itself.
+    """
+    rise_set_times = gsee.trigon.sun_rise_set_times(time_index, (latitude, longitude))
+    rise_set = dict(zip(rise_set_times.index.date, rise_set_times.values))
+    observer = ephem.Observer()
+    observer.lat = str(latitude)
+    observer.lon = str(longitude)
+    sun = ephem.Sun()
+
+    angles = np.empty((len(time_index), len(SUN_ANGLES)))
+    for position, time in enumerate(time_index.to_pydatetime()):
+        rise_time, set_time = rise_set[time.date()]
+        partial_hour = True
+        if rise_time is not None and time.hour == rise_time.hour:
+            # Sunrise hour, with the sun position halfway between sunrise and the next hour
+            duration = 60 - rise_time.minute - (rise_time.second / 60.0)
+            observer.date = rise_time + datetime.timedelta(minutes=duration / 2)
+        elif set_time is not None and time.hour == set_time.hour:
+            # Sunset hour, with the sun position halfway between the hour and sunset
+            duration = set_time.minute + set_time.second / 60.0
+            observer.date = time + datetime.timedelta(minutes=duration / 2)
+        else:
+            duration = 60
+            observer.date = time + datetime.timedelta(minutes=30)
+            partial_hour = False
+        sun.compute(observer)
+        if not partial_hour and sun.alt < 0:
+            # Sun below the horizon for the whole hour
+            angles[position] = 0, 0, np.pi / 2, 0
         else:
-            output = pd.concat([output, series], axis=1)
+            angles[position] = sun.alt, sun.az, np.pi / 2 - sun.alt, duration
+    # Sun altitude considered zero if slightly below horizon
+    angles[:, 0] = angles[:, 0].clip(min=0)
+    return angles
 
-    # Convert index to datetime
-    output.index = pd.to_datetime(output.index, utc=True)
-    # Convert to Thailand time
-    output.index = output.index.tz_convert(timezone)
-    return output
 
+def solar_angles(
+    time_index: pd.DatetimeIndex,
+    latitudes: np.ndarray,
+    longitudes: np.ndarray,
+    resolution: float | None = None,
+    executor: concurrent.futures.Executor | None = None,
+) -> dict[str, np.ndarray]:
+    """Return the sun position of many sites as (time x site) arrays.
 
-def create_solar(solar_df, data_folder):
+    The sun position is computed once per distinct location. With a `resolution`,
+    the sites are first snapped to a lat/lon grid of that size so that nearby sites
+    share one computation. Sites then also share the sunrise and sunset hours of
+    their grid point, which changes their factor in those hours.
+
+    Args:
+        time_index (pd.DatetimeIndex): Hourly time index of the weather data
+        latitudes (np.ndarray): Latitude of each site
+        longitudes (np.ndarray): Longitude of each site
+        resolution (float, optional): Size of the grid in degrees. Defaults to None,
+            which uses the coordinates of each site
+        executor (concurrent.futures.Executor, optional): Pool of processes computing the
+            locations in parallel. Defaults to None, which computes them in this process
+
+    Returns:
+        dict[str, np.ndarray]: The GSEE angles 'sun_alt', 'sun_azimuth' and 'sun_zenith'
+            (radians) and the 'duration' of sunshine (minutes) of each site
+    """
+    coords = np.column_stack([latitudes, longitudes]).astype(float)
+    if resolution is not None:
+        coords = np.round(coords / resolution) * resolution
+    locations, site_locations = np.unique(coords, axis=0, return_inverse=True)
+
+    location_angles = functools.partial(_location_angles, time_index)
+    if executor is None:
+        results = map(location_angles, locations[:, 0], locations[:, 1])
+    else:
+        results = executor.map(location_angles, locations[:, 0], locations[:, 1])
+    # A (time x location x angle) array
+    angles = np.stack(list(results), axis=1)
+    # Copy the angles of each location to its sites
+    site_locations = site_locations.reshape(-1)
+    return {
+        column: angles[:, site_locations, position]
+        for position, column in enumerate(SUN_ANGLES)
+    }
+
+
+def _solar_factors(
+    weather: dict[str, pd.DataFrame],
+    group_args: list[tuple],
+    angle_resolution: float | None = None,
+    executor: concurrent.futures.Executor | None = None,
+) -> np.ndarray:
+    """Return the hourly solar factor of many 1 W PV systems at once.
+
+    Same result as _solar_factor for each site, computed with NumPy on the
+    (time x site) weather arrays. GSEE rounds the diffuse irradiance of fixed
+    panels to float32, so results can differ in the 7th significant digit. Only
+    the sun position is computed per location, see solar_angles.
+
+    Args:
+        weather (dict[str, pd.DataFrame]): A (time x site) DataFrame for each weather variable
+        group_args (list[tuple]): The (latitude, longitude, tilt, azim, tracking) of each site
+        angle_resolution (float, optional): Grid size in degrees on which the sun position
+            is computed. Defaults to None, which uses the coordinates of each site
+        executor (concurrent.futures.Executor, optional): Pool of processes computing the
+            sun position, see solar_angles. Defaults to None
+
+    Returns:
+        np.ndarray: A (time x site) array of solar factors
+    """
+    time_index = weather["global_horizontal"].index
+    latitudes, longitudes, tilts, azims, trackings = (
+        np.array(column, dtype=float) for column in zip(*group_args)
+    )
+    supported = np.isin(trackings, (0, 1, 2))
+    if not supported.all():
+        raise ValueError(
+            f"tracking should be 0, 1 or 2. Unsupported: {trackings[~supported]}"
+        )
+    angles = solar_angles(time_index, latitudes, longitudes, angle_resolution, executor)
+    sun_alt = angles["sun_alt"]
+    sun_azimuth = angles["sun_azimuth"]
+
+    # Split the global radiation into direct and diffuse as in _solar_factor
+    global_horizontal = weather["global_horizontal"].to_numpy()
+    diffuse_fraction = (global_horizontal - weather["direct_shortwave"].to_numpy()) / (
+        global_horizontal + 0.0001
+    )
+    direct = global_horizontal * (1 - diffuse_fraction)
+    diffuse = global_horizontal * diffuse_fraction
+
+    tilt = np.radians(tilts)
+    # 180 degrees points north instead of south on the southern hemisphere
+    azimuth = np.radians(azims) + np.where(latitudes < 0, np.pi, 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        direct_normal = (direct * (angles["duration"] / 60)) / np.cos(
+            angles["sun_zenith"]
+        )
+        # Incidence angle and panel tilt of each tracking mode, as in gsee.trigon
+        incidence = np.where(
+            trackings == 2,
+            0,
+            np.arccos(
+                np.sin(sun_alt) * np.cos(tilt)
+                + np.cos(sun_alt) * np.sin(tilt) * np.cos(azimuth - sun_azimuth)
+            ),
+        )
+        panel_tilt = np.where(trackings == 2, angles["sun_zenith"], tilt)
+        single_tracking = trackings == 1
+        if single_tracking.any():
+            # 1-axis tracking with a horizontal or tilted axis
+            flat_axis = tilt == 0
+            sun_alt_1 = sun_alt[:, single_tracking]
+            tilt_1 = tilt[single_tracking]
+            flat_axis_1 = flat_axis[single_tracking]
+            relative_azimuth = (
+                sun_azimuth[:, single_tracking] - azimuth[single_tracking]
+            )
+            incidence[:, single_tracking] = np.where(
+                flat_axis_1,
+                np.arccos(
+                    np.sqrt(1 - np.cos(sun_alt_1) ** 2 * np.cos(relative_azimuth) ** 2)
+                ),
+                np.arccos(
+                    np.sqrt(
+                        1
+                        - (
+                            np.cos(sun_alt_1 + tilt_1)
+                            - np.cos(tilt_1)
+                            * np.cos(sun_alt_1)
+                            * (1 - np.cos(relative_azimuth))
+                        )
+                        ** 2
+                    )
+                ),
+            )
+            panel_tilt[:, single_tracking] = np.where(
+                flat_axis_1,
+                np.arctan(np.sin(relative_azimuth) / np.tan(sun_alt_1)),
+                np.arctan(
+                    (np.cos(sun_alt_1) * np.sin(relative_azimuth))
+                    / (
+                        np.sin(sun_alt_1 - tilt_1)
+                        + np.sin(tilt_1)
+                        * np.cos(sun_alt_1)
+                        * (1 - np.cos(relative_azimuth))
+                    )
+                ),
+            )
+
+        # Direct and diffuse irradiance on the plane of the panel, with an albedo of 0.3
+        plane_direct = direct_normal * np.cos(incidence)
+        plane_direct = np.where(np.isnan(plane_direct), 0, plane_direct).clip(min=0)
+        plane_diffuse = diffuse * ((1 + np.cos(panel_tilt)) / 2) + 0.3 * (
+            direct + diffuse
+        ) * ((1 - np.cos(panel_tilt)) / 2)
+        plane_diffuse = np.where(np.isnan(plane_diffuse), 0, plane_diffuse)
+
+    # Temperature-corrected output of the c-Si panel model of GSEE
+    panel = gsee.pv.CSiPanel(panel_aperture=0.001 / 0.1, panel_ref_efficiency=0.1)
+    power = panel.panel_power(
+        pd.DataFrame(plane_direct, index=time_index),
+        pd.DataFrame(plane_diffuse, index=time_index),
+        pd.DataFrame(weather["temperature"].to_numpy() - 273.15, index=time_index),
+    ).to_numpy()
+    # Clip to the 1 W capacity and apply the 10% system loss
+    return np.minimum(power, 1) * (1 - 0.10)
+
+
+def create_solar(
+    solar_df: pd.DataFrame,
+    data_folder: str,
+    group_by_cell: bool = False,
+    workers: int = 1,
+    start: str | pd.Timestamp | None = None,
+    end: str | pd.Timestamp | None = None,
+    cache_folder: str | None = None,
+    max_cache_bytes: int | None = None,
+    batch_size: int | None = BATCH_SIZE,
+    engine: str = "numpy",
+    angle_resolution: float | None = None,
+) -> pd.DataFrame:
+    """Create the hourly solar capacity of each site
+
+    Args:
+        solar_df (pd.DataFrame): Sites with columns 'name', 'max_capacity', 'latitude' and 'longitude',
+            and optionally 'tilt', 'azim' and 'tracking'. Missing values use DEFAULT_PV_SYSTEM
+        data_folder (str): Folder containing the monthly ERA5 files
+        group_by_cell (bool, optional): Run the PV model once for sites that share an ERA5
+            grid cell and model parameters, using the coordinates of the cell. Defaults to False
+        workers (int, optional): Number of processes computing the sun position of the numpy
+            engine, or running the PV model of the gsee engine. Defaults to 1
+        start (str | pd.Timestamp, optional): First local time to compute, e.g. '2023-01-01'.
+            Defaults to None, which starts with the downloaded data
+        end (str | pd.Timestamp, optional): End (exclusive) of the local period to compute,
+            e.g. '2024-01-01'. Defaults to None, which ends with the downloaded data
+        cache_folder (str, optional): Folder caching the solar factor of each site, so reruns
+            only compute new or changed sites. Defaults to None, which disables caching
+        max_cache_bytes (int, optional): Size limit of the cache. Defaults to None, which is unlimited
+        batch_size (int, optional): Number of sites (or groups) per batch. The weather of the
+            next batch is read while the PV model runs. Defaults to BATCH_SIZE. None reads all
+            sites at once, without overlap
+        engine (str, optional): 'numpy' to compute all sites at once with _solar_factors, or
+            'gsee' to run gsee.pv.run_model per site. Defaults to "numpy"
+        angle_resolution (float, optional): Grid size in degrees on which the numpy engine
+            computes the sun position, shared by the sites in each grid cell. This changes
+            the factors in the sunrise and sunset hours, see solar_angles. Defaults to None,
+            which computes it for the coordinates of each site
+
+    Returns:
+        pd.DataFrame: Solar capacity with one column per site
+    """
     # Map the variable names
     descriptive_to_era5 = {
         "global_horizontal": "msdwswrf",  # W/m^2
@@ -80,63 +1294,308 @@ def create_solar(solar_df, data_folder):
         "msdrswrf": "direct_shortwave",
         "t2m": "temperature",
     }
+    # Parameters of the PV model, with the default PV system for missing values
+    parameters = pd.DataFrame(index=solar_df.index)
+    for column, default in DEFAULT_PV_SYSTEM.items():
+        if column in solar_df.columns:
+            parameters[column] = solar_df[column].fillna(default)
+        else:
+            parameters[column] = default
+    parameters["tracking"] = parameters["tracking"].astype(int)
 
-    # Create the solar capacity dataframe
-    solar_capacity = pd.DataFrame()
-    for _, row in solar_df.iterrows():
-        #########################
-        # Create the weather data
-        #########################
-        latitude = row["latitude"]
-        longitude = row["longitude"]
+    # Each site is modelled on its own unless grouped by grid cell
+    if group_by_cell:
+        cells = site_grid_cells(
+            data_folder,
+            next(iter(descriptive_to_era5)),
+            latitudes=solar_df["latitude"].values,
+            longitudes=solar_df["longitude"].values,
+        )
+        site_groups = group_sites(cells, parameters)
+    else:
+        cells = solar_df[["latitude", "longitude"]].reset_index(drop=True)
+        site_groups = np.arange(len(solar_df))
+    # The first site of each group represents the group
+    _, group_sites_idx = np.unique(site_groups, return_index=True)
+    group_cells = cells.iloc[group_sites_idx]
+    group_parameters = parameters.iloc[group_sites_idx]
 
-        weather_data = create_weather_data(
+    def extract_weather(groups: np.ndarray) -> dict[str, pd.DataFrame]:
+        # Extract the weather data of the groups at once
+        weather = create_weather_batch(
             descriptive_to_era5,
-            latitude=latitude,
-            longitude=longitude,
+            latitudes=group_cells["latitude"].values[groups],
+            longitudes=group_cells["longitude"].values[groups],
             data_folder=data_folder,
-        ).rename(columns=weather_columns)
-        # The GSEE package expects the temperature in Celsius
-        weather_data["temperature"] = weather_data["temperature"] - 273.15
-        # Calculate the diffuse fraction
-        weather_data["diffuse"] = (
-            weather_data["global_horizontal"] - weather_data["direct_shortwave"]
-        )
-        weather_data["diffuse_fraction"] = weather_data["diffuse"] / (
-            weather_data["global_horizontal"] + 0.0001
-        )
-
-        #########################
-        # Calculate the solar capacity
-        #########################
-        name = row["name"]
-        max_capacity = row["max_capacity"]
-
-        # The gsee.pv.run_model function expects the following columns:
-        # - temperature: Temperature in Celsius
-        # - global_horizontal: Total radiation in W/m^2
-        # - diffuse_fraction: Diffuse fraction
-        solar_factor = gsee.pv.run_model(
-            data=weather_data,
-            coords=(latitude, longitude),
-            tilt=35,
-            azim=180,
-            tracking=0,  # No tracking
-            capacity=1,  # Use 1 W so we can scale it later
-        )
-        # Solar capacity is the max_capacity of the solar farm multiplied by the solar factor
-        site_capacity = solar_factor * max_capacity
-        # Round to 4 decimal places
-        site_capacity = site_capacity.round(4)
-        site_capacity.name = name
-
-        # Append to the solar_capacity dataframe
-        if site_capacity.empty:
-            solar_capacity = site_capacity
-        else:
-            solar_capacity = pd.concat([solar_capacity, site_capacity], axis=1)
+            start=start,
+            end=end,
+        )
+        # Rename the columns as required by GSEE
+        return {weather_columns[varname]: series for varname, series in weather.items()}
+
+    group_args = [
+        (
+            group_cells["latitude"].iloc[group],
+            group_cells["longitude"].iloc[group],
+            group_parameters["tilt"].iloc[group],
+            group_parameters["azim"].iloc[group],
+            group_parameters["tracking"].iloc[group],
+        )
+        for group in range(len(group_cells))
+    ]
+
+    # The cache key covers every input of the solar factor
+    group_keys = None
+    if cache_folder is not None:
+        fingerprint = factor_cache.era5_fingerprint(
+            era5_inputs(data_folder, list(descriptive_to_era5), start, end)
+        )
+        period = [None if t is None else pd.Timestamp(t) for t in (start, end)]
+        group_keys = [
+            factor_cache.factor_key(
+                technology="solar",
+                model=f"gsee {gsee.__version__}",
+                engine=engine,
+                coords=args[:2],
+                tilt=args[2],
+                azim=args[3],
+                tracking=args[4],
+                angle_resolution=angle_resolution if engine == "numpy" else None,
+                period=period,
+                era5=fingerprint,
+            )
+            for args in group_args
+        ]
+
+    if engine not in ("numpy", "gsee"):
+        raise ValueError(f"engine should be 'numpy' or 'gsee'. Unsupported: {engine}")
+    # Solar capacity is the max_capacity of the solar farm multiplied by the solar factor
+    time_index, solar_capacity = compute_capacity(
+        (
+            functools.partial(_solar_factors, angle_resolution=angle_resolution)
+            if engine == "numpy"
+            else _solar_factor
+        ),
+        extract_weather,
+        group_args,
+        site_groups=site_groups,
+        max_capacities=solar_df["max_capacity"].values,
+        workers=workers,
+        cache_folder=cache_folder,
+        group_keys=group_keys,
+        max_cache_bytes=max_cache_bytes,
+        batch_size=batch_size,
+        vectorized=engine == "numpy",
+    )
+
+    # Round to 4 decimal places
+    np.round(solar_capacity, 4, out=solar_capacity)
     # Save as solar.csv
-    return solar_capacity
+    return pd.DataFrame(
+        solar_capacity, index=time_index, columns=solar_df["name"].values
+    )
+
+
+def write_capacity(
+    capacity: pd.DataFrame, filename: str, dtype: str = "float32"
+) -> None:
+    """Write hourly capacity to a Parquet (.parquet) or Arrow IPC (.arrow) file.
+
+    Unlike solar.csv and wind.csv, the time index is kept. The columns are the unit
+    names, which must be unique, and the (unit, substation) pairs of the MultiIndex
+    columns are stored in the file metadata. Requires pyarrow.
+
+    Args:
+        capacity (pd.DataFrame): Output of create_solar or create_wind, optionally with
+            (unit, substation) MultiIndex columns
+        filename (str): Output file ending with '.parquet' or '.arrow'
+        dtype (str, optional): 'float32', or 'uint16' to store the values scaled by a
+            per-unit factor kept in the metadata. Defaults to "float32"
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = _capacity_table(capacity, dtype)
+    if filename.endswith(".parquet"):
+        pq.write_table(table, filename)
+    elif filename.endswith(".arrow"):
+        with pa.OSFile(filename, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+    else:
+        raise ValueError(f"Filename should end with '.parquet' or '.arrow': {filename}")
+
+
+def _capacity_table(
+    capacity: pd.DataFrame, dtype: str, scales: np.ndarray | None = None
+) -> pa.Table:
+    """Convert capacity to a pyarrow Table for write_capacity and stream_capacity.
+
+    With dtype 'uint16', the scales default to the maximum of each unit over `capacity`.
+    """
+    import pyarrow as pa
+
+    if isinstance(capacity.columns, pd.MultiIndex):
+        units = capacity.columns.get_level_values(0).tolist()
+        substations = capacity.columns.get_level_values(1).tolist()
+    else:
+        units = capacity.columns.tolist()
+        substations = [None] * len(units)
+    # Each unit is stored as a column named after it and read back by name
+    duplicates = pd.Index(units)[pd.Index(units).duplicated()].unique().tolist()
+    if duplicates:
+        raise ValueError(f"Unit names should be unique. Duplicated: {duplicates}")
+
+    if dtype == "float32":
+        values = capacity.to_numpy(dtype=np.float32)
+        scales = None
+    elif dtype == "uint16":
+        if capacity.isna().any().any():
+            raise ValueError("Capacity with missing values cannot be stored as uint16")
+        if scales is None:
+            # The maximum of each unit is mapped to the largest uint16 value
+            scales = capacity.max().to_numpy(dtype=np.float64) / np.iinfo(np.uint16).max
+            scales[scales == 0] = 1
+        values = np.round(capacity.to_numpy() / scales).astype(np.uint16)
+        scales = np.asarray(scales).tolist()
+    else:
+        raise ValueError(f"dtype should be 'float32' or 'uint16'. Unsupported: {dtype}")
+
+    time_col = capacity.index.name or "time"
+    table = pa.table(
+        {
+            time_col: capacity.index,
+            **{unit: values[:, i] for i, unit in enumerate(units)},
+        }
+    )
+    metadata = {
+        "time_column": time_col,
+        "units": units,
+        "substations": substations,
+        "scales": scales,
+    }
+    return table.replace_schema_metadata({"pownet": json.dumps(metadata)})
+
+
+def stream_capacity(
+    create_capacity: Callable[..., pd.DataFrame],
+    sites_df: pd.DataFrame,
+    data_folder: str,
+    filename: str,
+    start: str | pd.Timestamp,
+    end: str | pd.Timestamp,
+    freq: str = "YS",
+    dtype: str = "float32",
+    substations: dict[str, str] | None = None,
+    **kwargs,
+) -> None:
+    """Compute the capacity of a long period one part at a time and append it to a file.
+
+    Only one part (a year by default) is held in memory. Each part reads the ERA5
+    hours before and after it that its timezone needs, so the parts join without
+    gaps. The output is written like write_capacity and read with read_capacity.
+
+    Args:
+        create_capacity (Callable[..., pd.DataFrame]): create_solar or extract_wind.create_wind
+        sites_df (pd.DataFrame): Sites with columns 'name', 'max_capacity', 'latitude' and 'longitude'
+        data_folder (str): Folder containing the ERA5 files, e.g. the cache of get_era5.get_era5_years
+        filename (str): Output file ending with '.parquet' or '.arrow'
+        start (str | pd.Timestamp): First local time, e.g. '2000-01-01'
+        end (str | pd.Timestamp): End (exclusive) of the local period, e.g. '2024-01-01'
+        freq (str, optional): Length of each part as a pandas frequency, e.g. 'MS' for
+            months. Defaults to "YS"
+        dtype (str, optional): 'float32', or 'uint16' scaled by the max_capacity of each
+            unit. Defaults to "float32"
+        substations (dict[str, str], optional): Substation of each unit, stored as in
+            write_capacity. Defaults to None
+        **kwargs: Other arguments of `create_capacity`, e.g. workers or cache_folder
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if not filename.endswith((".parquet", ".arrow")):
+        raise ValueError(f"Filename should end with '.parquet' or '.arrow': {filename}")
+
+    # Fixed scales keep the parts consistent, as capacity never exceeds max_capacity
+    scales = None
+    if dtype == "uint16":
+        scales = sites_df["max_capacity"].to_numpy(dtype=np.float64)
+        scales = scales / np.iinfo(np.uint16).max
+        scales[scales == 0] = 1
+
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    bounds = pd.date_range(start, end, freq=freq)
+    bounds = bounds.union(pd.DatetimeIndex([start, end]))
+
+    # Write to a temporary file first so an interrupted run leaves no partial output
+    temp_filename = f"{filename}.tmp"
+    writer = sink = None
+    try:
+        for part_start, part_end in zip(bounds[:-1], bounds[1:]):
+            capacity = create_capacity(
+                sites_df, data_folder, start=part_start, end=part_end, **kwargs
+            )
+            if substations is not None:
+                capacity.columns = pd.MultiIndex.from_tuples(
+                    [(unit, substations[unit]) for unit in capacity.columns]
+                )
+            table = _capacity_table(capacity, dtype, scales)
+            del capacity
+
+            if writer is None:
+                if filename.endswith(".parquet"):
+                    writer = pq.ParquetWriter(temp_filename, table.schema)
+                else:
+                    sink = pa.OSFile(temp_filename, "wb")
+                    writer = pa.ipc.new_file(sink, table.schema)
+            writer.write_table(table)
+            print(f"Wrote {part_start:%Y-%m-%d} to {part_end:%Y-%m-%d}")
+    finally:
+        if writer is not None:
+            writer.close()
+        if sink is not None:
+            sink.close()
+    os.replace(temp_filename, filename)
+
+
+def read_capacity(filename: str) -> pd.DataFrame:
+    """Read a file written by write_capacity using memory mapping.
+
+    Args:
+        filename (str): File ending with '.parquet' or '.arrow'
+
+    Returns:
+        pd.DataFrame: Capacity indexed by time, with (unit, substation) MultiIndex columns
+        if the substations were stored
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if filename.endswith(".parquet"):
+        table = pq.read_table(filename, memory_map=True)
+    elif filename.endswith(".arrow"):
+        with pa.memory_map(filename) as source:
+            table = pa.ipc.open_file(source).read_all()
+    else:
+        raise ValueError(f"Filename should end with '.parquet' or '.arrow': {filename}")
+
+    metadata = json.loads(table.schema.metadata[b"pownet"])
+    values = np.column_stack(
+        [table.column(unit).to_numpy() for unit in metadata["units"]]
+    )
+    if metadata["scales"] is not None:
+        values = values * np.asarray(metadata["scales"], dtype=np.float32)
+
+    if any(substation is not None for substation in metadata["substations"]):
+        columns = pd.MultiIndex.from_arrays(
+            [metadata["units"], metadata["substations"]]
+        )
+    else:
+        columns = pd.Index(metadata["units"])
+    time_index = pd.Index(
+        table.column(metadata["time_column"]).to_pandas(), name=metadata["time_column"]
+    )
+    return pd.DataFrame(values, index=time_index, columns=columns)
 
 
 if __name__ == "__main__":
@@ -144,7 +1603,10 @@ if __name__ == "__main__":
     spp_renew = pd.read_csv("nondispatch_spp.csv")
     solar_df = spp_renew[spp_renew["spp_fuel"] == "solar"]
     data_folder = "./solar_data"
-    solar_capacity = create_solar(solar_df, data_folder)
+    output_format = "csv"  # Either 'csv' or 'parquet'
+    year = 2023
+    # A later end year streams every year from `year` to solar.parquet, one year at a time
+    end_year = year
 
     # Assign the solar units to the nearest substation
     substations = gpd.read_file("../clean_buses.geojson")
@@ -154,12 +1616,31 @@ if __name__ == "__main__":
         source_name_col="name",
         substation_geo_col="geometry",
     )
-    col_idx = pd.MultiIndex.from_tuples(
-        [(col, nearest_bus_map[col]) for col in solar_capacity.columns]
-    )
-    solar_capacity.columns = col_idx
 
-    solar_capacity.index = pd.to_datetime(solar_capacity.index)
-    solar_capacity = solar_capacity.loc[solar_capacity.index.year == 2023]
-    solar_capacity.to_csv("./clean_data/solar.csv", index=False)
-    print("solar.csv saved.")
+    if end_year > year:
+        stream_capacity(
+            create_solar,
+            solar_df,
+            data_folder,
+            "./clean_data/solar.parquet",
+            start=f"{year}-01-01",
+            end=f"{end_year + 1}-01-01",
+            substations=nearest_bus_map,
+        )
+        print("solar.parquet saved.")
+    else:
+        # Only the target year is computed, in local time
+        solar_capacity = create_solar(
+            solar_df, data_folder, start=f"{year}-01-01", end=f"{year + 1}-01-01"
+        )
+        col_idx = pd.MultiIndex.from_tuples(
+            [(col, nearest_bus_map[col]) for col in solar_capacity.columns]
+        )
+        solar_capacity.columns = col_idx
+
+        if output_format == "parquet":
+            write_capacity(solar_capacity, "./clean_data/solar.parquet")
+            print("solar.parquet saved.")
+        else:
+            solar_capacity.to_csv("./clean_data/solar.csv", index=False)
+            print("solar.csv saved.")
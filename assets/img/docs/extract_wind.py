@@ -1,8 +1,9 @@
 """ Create wind.csv.
 
 Note:
-- Assume GE100/2500 wind turbine (General Electric)
-- Assume hub height is 100m.
+- Assume GE100/2500 wind turbine (General Electric) unless the sites have a
+'turbine_type' column
+- Assume hub height is 100m unless the sites have a 'hub_height' column
 - Assume no temperature changes at 2m and 10m.
 - The data include wind speed at two different heights in m/s, air temperature
 in two different heights in K, surface roughness length in m
@@ -10,18 +11,273 @@ and air pressure in Pa.
 
 """
 
+import concurrent.futures
+import json
+import os
+import threading
+
 import geopandas as gpd
+import numpy as np
 import pandas as pd
 import windpowerlib
-from extract_solar import create_weather_data
+import factor_cache
+from extract_solar import (
+    BATCH_SIZE,
+    compute_capacity,
+    create_weather_batch,
+    era5_inputs,
+    group_sites,
+    site_grid_cells,
+    stream_capacity,
+    write_capacity,
+)
 from nearest_point import assign_nearest_substation
 
-spp_renew = pd.read_csv("nondispatch_spp.csv")
-wind_df = spp_renew[spp_renew["spp_fuel"] == "wind"]
-data_folder = "./wind_data"
+# Turbine of the sites without 'turbine_type' or 'hub_height'
+DEFAULT_TURBINE = {
+    "turbine_type": "GE100/2500",
+    "hub_height": 100,  # meters
+}
+
+# Turbines loaded in this process, by (turbine_type, hub_height)
+_TURBINES = {}
+_TURBINES_LOCK = threading.Lock()
+
 
+def _wind_factor(
+    weather_data: pd.DataFrame, turbine: windpowerlib.WindTurbine
+) -> np.ndarray:
+    """Return the hourly power factor of a wind turbine"""
+    # Columns need height as the second-level index
+    heights = {
+        "10m_speed": 10,
+        "100m_speed": 100,
+        "temperature": 2,
+        "roughness_length": 0,
+        "pressure": 0,
+    }
+
+    weather_data = weather_data.copy()
+    # Calculate wind speed from u and v components
+    weather_data["10m_speed"] = (
+        weather_data["10uwind"] ** 2 + weather_data["10vwind"] ** 2
+    ) ** 0.5
+    weather_data["100m_speed"] = (
+        weather_data["100uwind"] ** 2 + weather_data["100vwind"] ** 2
+    ) ** 0.5
+    # Drop the u and v components
+    weather_data = weather_data.drop(
+        columns=["10uwind", "10vwind", "100uwind", "100vwind"]
+    )
+
+    # windpowerlib requires height as the second-level index
+    weather_data.columns = pd.MultiIndex.from_tuples(
+        [(col, heights[col]) for col in weather_data.columns],
+        names=["variable_name", "height"],
+    )
+
+    # Rename columns to those required by the windpowerlib
+    weather_data = weather_data.rename(
+        columns={
+            "10m_speed": "wind_speed",
+            "100m_speed": "wind_speed",
+            "2m_temperature": "temperature",
+            "roughness_length": "roughness_length",
+            "pressure": "pressure",
+        }
+    )
+
+    # Calculate wind capacity using default parameters of ModelChain
+    model_chain = windpowerlib.ModelChain(turbine).run_model(weather_data)
+    # Power output in W, so convert to MW
+    power_output = model_chain.power_output / 1e6
+    # Normalize the power output by the rated capacity to get a factor that can be
+    # multiplied by the site's capacity to get the actual power output
+    power_factor = power_output / (turbine.nominal_power / 1e6)
+    return power_factor.values
+
+
+def get_turbine(
+    turbine_type: str, hub_height: float, turbine_library: str | None = None
+) -> windpowerlib.WindTurbine:
+    """Return a turbine, loading its power curve only once per process.
+
+    windpowerlib reads its turbine database for every new WindTurbine. Turbines are
+    kept in memory here, and their power curves can also be kept in a JSON file so
+    later runs and worker processes do not read the database at all.
+
+    Args:
+        turbine_type (str): Turbine type in the windpowerlib database, e.g. 'GE100/2500'
+        hub_height (float): Hub height (m)
+        turbine_library (str, optional): JSON file of power curves shared between runs.
+            Defaults to None, which only keeps the turbines in memory
+
+    Returns:
+        windpowerlib.WindTurbine: Turbine with its power curve and nominal power
+    """
+    key = (turbine_type, float(hub_height))
+    with _TURBINES_LOCK:
+        if key in _TURBINES:
+            return _TURBINES[key]
+
+        library = {}
+        if turbine_library is not None and os.path.exists(turbine_library):
+            with open(turbine_library) as file:
+                library = json.load(file)
+
+        if turbine_type in library:
+            entry = library[turbine_type]
+            turbine = windpowerlib.WindTurbine(
+                hub_height=hub_height,
+                nominal_power=entry["nominal_power"],
+                power_curve=pd.DataFrame(
+                    {"wind_speed": entry["wind_speed"], "value": entry["value"]}
+                ),
+                turbine_type=turbine_type,
+            )
+        else:
+            turbine = windpowerlib.WindTurbine(
+                turbine_type=turbine_type, hub_height=hub_height
+            )
+            if turbine.power_curve is None:
+                raise ValueError(f"No power curve for turbine type {turbine_type}")
+            if turbine_library is not None:
+                library[turbine_type] = {
+                    "nominal_power": turbine.nominal_power,
+                    "wind_speed": turbine.power_curve["wind_speed"].tolist(),
+                    "value": turbine.power_curve["value"].tolist(),
+                }
+                with open(f"{turbine_library}.tmp", "w") as file:
+                    json.dump(library, file)
+                os.replace(f"{turbine_library}.tmp", turbine_library)
+
+        _TURBINES[key] = turbine
+        return turbine
+
+
+def wind_speed_hub(
+    wind_speeds: dict[float, np.ndarray],
+    roughness_length: np.ndarray,
+    hub_height: float,
+    obstacle_height: float = 0.0,
+) -> np.ndarray:
+    """Return the wind speed at hub height as the default logarithmic model of windpowerlib.
+
+    The wind speed at hub height is used as is if available. Otherwise the wind
+    speed at the closest height is extrapolated with the logarithmic wind profile.
+
+    Args:
+        wind_speeds (dict[float, np.ndarray]): Wind speed (m/s) at each height (m)
+        roughness_length (np.ndarray): Roughness length (m), same shape as the wind speeds
+        hub_height (float): Hub height (m)
+        obstacle_height (float, optional): Height of obstacles (m). Defaults to 0.0
+
+    Returns:
+        np.ndarray: Wind speed (m/s) at hub height
+    """
+    if hub_height in wind_speeds:
+        return wind_speeds[hub_height]
+    closest_height = min(wind_speeds, key=lambda height: abs(height - hub_height))
+    return (
+        wind_speeds[closest_height]
+        * np.log((hub_height - 0.7 * obstacle_height) / roughness_length)
+        / np.log((closest_height - 0.7 * obstacle_height) / roughness_length)
+    )
 
-def create_wind(wind_df: pd.DataFrame, data_folder: str) -> pd.DataFrame:
+
+def _wind_factors(
+    weather: dict[str, pd.DataFrame],
+    group_args: list[tuple],
+    executor: concurrent.futures.Executor | None = None,
+) -> np.ndarray:
+    """Return the hourly power factor of many sites at once.
+
+    Same result as _wind_factor for each site, computed with NumPy on the
+    (time x site) weather arrays. Sites with the same turbine share one
+    power curve lookup.
+
+    Args:
+        weather (dict[str, pd.DataFrame]): A (time x site) DataFrame for each weather variable
+        group_args (list[tuple]): The turbine of each site, as (windpowerlib.WindTurbine,)
+        executor (concurrent.futures.Executor, optional): Pool of worker processes passed by
+            compute_capacity. Unused, as the model runs in this process. Defaults to None
+
+    Returns:
+        np.ndarray: A (time x site) array of power factors
+    """
+    values = {varname: series.to_numpy() for varname, series in weather.items()}
+    # Calculate wind speed from u and v components
+    wind_speeds = {
+        10: (values["10uwind"] ** 2 + values["10vwind"] ** 2) ** 0.5,
+        100: (values["100uwind"] ** 2 + values["100vwind"] ** 2) ** 0.5,
+    }
+
+    # Sites with the same turbine are computed together
+    turbine_sites = {}
+    for site, (turbine,) in enumerate(group_args):
+        turbine_sites.setdefault(id(turbine), (turbine, []))[1].append(site)
+
+    factors = np.empty(values["10uwind"].shape)
+    for turbine, sites in turbine_sites.values():
+        hub_speed = wind_speed_hub(
+            {height: speed[:, sites] for height, speed in wind_speeds.items()},
+            values["roughness_length"][:, sites],
+            turbine.hub_height,
+        )
+        # Power curve without density correction, zero outside the curve
+        power_output = np.interp(
+            hub_speed,
+            turbine.power_curve["wind_speed"].values,
+            turbine.power_curve["value"].values,
+            left=0,
+            right=0,
+        )
+        # Power output in W, so convert to MW and normalize by the rated capacity
+        factors[:, sites] = power_output / 1e6 / (turbine.nominal_power / 1e6)
+    return factors
+
+
+def create_wind(
+    wind_df: pd.DataFrame,
+    data_folder: str,
+    group_by_cell: bool = False,
+    workers: int = 1,
+    start: str | pd.Timestamp | None = None,
+    end: str | pd.Timestamp | None = None,
+    cache_folder: str | None = None,
+    max_cache_bytes: int | None = None,
+    batch_size: int | None = BATCH_SIZE,
+    engine: str = "numpy",
+    turbine_library: str | None = None,
+) -> pd.DataFrame:
+    """Create the hourly wind capacity of each site
+
+    Args:
+        wind_df (pd.DataFrame): Sites with columns 'name', 'max_capacity', 'latitude' and 'longitude',
+            and optionally 'turbine_type' and 'hub_height' (m). Missing values use DEFAULT_TURBINE
+        data_folder (str): Folder containing the monthly ERA5 files
+        group_by_cell (bool, optional): Run the wind model once for sites that share an ERA5
+            grid cell and turbine. Defaults to False
+        workers (int, optional): Number of processes running the wind model of the windpowerlib
+            engine. The numpy engine runs in this process. Defaults to 1
+        start (str | pd.Timestamp, optional): First local time to compute, e.g. '2023-01-01'.
+            Defaults to None, which starts with the downloaded data
+        end (str | pd.Timestamp, optional): End (exclusive) of the local period to compute,
+            e.g. '2024-01-01'. Defaults to None, which ends with the downloaded data
+        cache_folder (str, optional): Folder caching the power factor of each site, so reruns
+            only compute new or changed sites. Defaults to None, which disables caching
+        max_cache_bytes (int, optional): Size limit of the cache. Defaults to None, which is unlimited
+        batch_size (int, optional): Number of sites (or groups) per batch. The weather of the
+            next batch is read while the wind model runs. Defaults to BATCH_SIZE. None reads all
+            sites at once, without overlap
+        engine (str, optional): 'numpy' to compute all sites at once with _wind_factors, or
+            'windpowerlib' to run a ModelChain per site. Defaults to "numpy"
+        turbine_library (str, optional): JSON file keeping the power curves between runs,
+            see get_turbine. Defaults to None
+
+    Returns:
+        pd.DataFrame: Wind capacity with one column per site
+    """
     # The units are aligned with the windpowerlib
     descriptive_to_era5 = {
         "100uwind": "u100",  # m/s
@@ -41,94 +297,104 @@ def create_wind(wind_df: pd.DataFrame, data_folder: str) -> pd.DataFrame:
         "sp": "pressure",
         "t2m": "temperature",
     }
-    # Columns need height as the second-level index
-    heights = {
-        "10m_speed": 10,
-        "100m_speed": 100,
-        "temperature": 2,
-        "roughness_length": 0,
-        "pressure": 0,
-    }
-    # Define turbine
-    ge_turbine = {
-        "turbine_type": "GE100/2500",
-        "hub_height": 100,  # meters
-    }
-    ge_turbine = windpowerlib.WindTurbine(**ge_turbine)
+    # Turbine of each site, with the default turbine for missing values
+    parameters = pd.DataFrame(index=wind_df.index)
+    for column, default in DEFAULT_TURBINE.items():
+        if column in wind_df.columns:
+            parameters[column] = wind_df[column].fillna(default)
+        else:
+            parameters[column] = default
+    parameters["hub_height"] = parameters["hub_height"].astype(float)
 
-    wind_capacity = pd.DataFrame()
-    for _, row in wind_df.iterrows():
-        #########################
-        # Create the weather data
-        #########################
-        latitude = row["latitude"]
-        longitude = row["longitude"]
+    # Each site is modelled on its own unless grouped by grid cell
+    if group_by_cell:
+        cells = site_grid_cells(
+            data_folder,
+            next(iter(descriptive_to_era5)),
+            latitudes=wind_df["latitude"].values,
+            longitudes=wind_df["longitude"].values,
+        )
+        site_groups = group_sites(cells, parameters)
+    else:
+        cells = wind_df[["latitude", "longitude"]].reset_index(drop=True)
+        site_groups = np.arange(len(wind_df))
+    # The first site of each group represents the group
+    _, group_sites_idx = np.unique(site_groups, return_index=True)
+    group_cells = cells.iloc[group_sites_idx]
+    group_parameters = parameters.iloc[group_sites_idx]
+    # Sites with the same turbine share one turbine object
+    group_turbines = [
+        get_turbine(turbine_type, hub_height, turbine_library)
+        for turbine_type, hub_height in group_parameters.itertuples(index=False)
+    ]
 
-        weather_data = create_weather_data(
+    def extract_weather(groups: np.ndarray) -> dict[str, pd.DataFrame]:
+        # Extract the weather data of the groups at once
+        weather = create_weather_batch(
             descriptive_to_era5,
-            latitude=latitude,
-            longitude=longitude,
+            latitudes=group_cells["latitude"].values[groups],
+            longitudes=group_cells["longitude"].values[groups],
             data_folder=data_folder,
-        ).rename(columns=weather_columns)
-
-        # Calculate wind speed from u and v components
-        weather_data["10m_speed"] = (
-            weather_data["10uwind"] ** 2 + weather_data["10vwind"] ** 2
-        ) ** 0.5
-        weather_data["100m_speed"] = (
-            weather_data["100uwind"] ** 2 + weather_data["100vwind"] ** 2
-        ) ** 0.5
-        # Drop the u and v components
-        weather_data = weather_data.drop(
-            columns=["10uwind", "10vwind", "100uwind", "100vwind"]
+            start=start,
+            end=end,
         )
+        # Rename the columns as required by the wind model
+        return {weather_columns[varname]: series for varname, series in weather.items()}
 
-        # windpowerlib requires height as the second-level index
-        weather_data.columns = pd.MultiIndex.from_tuples(
-            [(col, heights[col]) for col in weather_data.columns],
-            names=["variable_name", "height"],
+    # The cache key covers every input of the power factor
+    group_keys = None
+    if cache_folder is not None:
+        fingerprint = factor_cache.era5_fingerprint(
+            era5_inputs(data_folder, list(descriptive_to_era5), start, end)
         )
+        period = [None if t is None else pd.Timestamp(t) for t in (start, end)]
+        group_keys = [
+            factor_cache.factor_key(
+                technology="wind",
+                model=f"windpowerlib {windpowerlib.__version__}",
+                engine=engine,
+                coords=(latitude, longitude),
+                turbine_type=turbine.turbine_type,
+                hub_height=turbine.hub_height,
+                period=period,
+                era5=fingerprint,
+            )
+            for (latitude, longitude), turbine in zip(
+                group_cells.itertuples(index=False), group_turbines
+            )
+        ]
 
-        # Rename columns to those required by the windpowerlib
-        weather_data = weather_data.rename(
-            columns={
-                "10m_speed": "wind_speed",
-                "100m_speed": "wind_speed",
-                "2m_temperature": "temperature",
-                "roughness_length": "roughness_length",
-                "pressure": "pressure",
-            }
+    if engine not in ("numpy", "windpowerlib"):
+        raise ValueError(
+            f"engine should be 'numpy' or 'windpowerlib'. Unsupported: {engine}"
         )
+    time_index, wind_capacity = compute_capacity(
+        _wind_factors if engine == "numpy" else _wind_factor,
+        extract_weather,
+        [(turbine,) for turbine in group_turbines],
+        site_groups=site_groups,
+        max_capacities=wind_df["max_capacity"].values,
+        workers=workers,
+        cache_folder=cache_folder,
+        group_keys=group_keys,
+        max_cache_bytes=max_cache_bytes,
+        batch_size=batch_size,
+        vectorized=engine == "numpy",
+    )
 
-        #########################
-        # Calculate wind capacity using default parameters of ModelChain
-        #########################
-        name = row["name"]
-        max_capacity = row["max_capacity"]
-
-        model_chain = windpowerlib.ModelChain(ge_turbine).run_model(weather_data)
-        # Power output in W, so convert to MW. The rated capacity is 2.5 MW
-        power_output = model_chain.power_output / 1e6
-        # Normalize the power output to get a factor that can be multiplied by the
-        # site's capacity to get the actual power output
-        power_factor = power_output / 2.5
-        site_capacity = power_factor * max_capacity
-        # Round to 4 decimal places
-        site_capacity = site_capacity.round(4)
-        site_capacity.name = name
-
-        if wind_capacity.empty:
-            wind_capacity = site_capacity
-        else:
-            wind_capacity = pd.concat([wind_capacity, site_capacity], axis=1)
-    return wind_capacity
+    # Round to 4 decimal places
+    np.round(wind_capacity, 4, out=wind_capacity)
+    return pd.DataFrame(wind_capacity, index=time_index, columns=wind_df["name"].values)
 
 
 if __name__ == "__main__":
     spp_renew = pd.read_csv("nondispatch_spp.csv")
     wind_df = spp_renew[spp_renew["spp_fuel"] == "wind"]
     data_folder = "./wind_data"
-    wind_capacity = create_wind(wind_df, data_folder)
+    output_format = "csv"  # Either 'csv' or 'parquet'
+    year = 2023
+    # A later end year streams every year from `year` to wind.parquet, one year at a time
+    end_year = year
 
     # Assign units to the nearest substation
     substations = gpd.read_file("../clean_buses.geojson")
@@ -138,11 +404,28 @@ if __name__ == "__main__":
         source_name_col="name",
         substation_geo_col="geometry",
     )
-    col_idx = pd.MultiIndex.from_tuples(
-        [(col, nearest_bus_map[col]) for col in wind_capacity.columns]
-    )
-    wind_capacity.columns = col_idx
-    wind_capacity.index = pd.to_datetime(wind_capacity.index)
-    wind_capacity = wind_capacity.loc[wind_capacity.index.year == 2023]
-    wind_capacity.to_csv("./clean_data/wind.csv", index=False)
+
+    if end_year > year:
+        stream_capacity(
+            create_wind,
+            wind_df,
+            data_folder,
+            "./clean_data/wind.parquet",
+            start=f"{year}-01-01",
+            end=f"{end_year + 1}-01-01",
+            substations=nearest_bus_map,
+        )
+    else:
+        # Only the target year is computed, in local time
+        wind_capacity = create_wind(
+            wind_df, data_folder, start=f"{year}-01-01", end=f"{year + 1}-01-01"
+        )
+        col_idx = pd.MultiIndex.from_tuples(
+            [(col, nearest_bus_map[col]) for col in wind_capacity.columns]
+        )
+        wind_capacity.columns = col_idx
+        if output_format == "parquet":
+            write_capacity(wind_capacity, "./clean_data/wind.parquet")
+        else:
+            wind_capacity.to_csv("./clean_data/wind.csv", index=False)
     print("Wind capacity data saved.")
@@ -0,0 +1,219 @@
+""" On-disk cache of capacity factors for extract_solar.py and extract_wind.py.
+
+Each entry is the hourly capacity factor of one site (or group of sites) saved as
+a .npz file. The file name is a hash of everything the factor depends on: the
+technology, coordinates, model parameters, period, model version and a
+fingerprint of the ERA5 files. A changed input therefore gives a new entry
+instead of a stale one, and old entries are removed by evict_cache.
+
+"""
+
+import datetime
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def era5_fingerprint(filenames: list[str]) -> str:
+    """Return a fingerprint of ERA5 files based on their names, sizes and modification times.
+
+    Args:
+        filenames (list[str]): ERA5 files used to compute the factors
+
+    Returns:
+        str: Hexadecimal digest that changes when any of the files changes
+    """
+    digest = hashlib.sha256()
+    for filename in filenames:
+        stat = os.stat(filename)
+        digest.update(
+            f"{os.path.basename(filename)}:{stat.st_size}:{stat.st_mtime_ns};".encode()
+        )
+    return digest.hexdigest()
+
+
+def file_checksum(filename: str, block_size: int = 1 << 20) -> str:
+    """Return the SHA-256 checksum of a file"""
+    digest = hashlib.sha256()
+    with open(filename, "rb") as file:
+        while block := file.read(block_size):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def era5_inputs(filenames: list[str]) -> dict[str, dict]:
+    """Return the size, modification time and checksum of ERA5 files.
+
+    get_era5.rechunk_data stores this record in the merged file, so the merged
+    file can be checked against the monthly files it was made from.
+
+    Args:
+        filenames (list[str]): ERA5 files
+
+    Returns:
+        dict[str, dict]: The 'bytes', 'mtime_ns' and 'sha256' of each file name
+    """
+    inputs = {}
+    for filename in filenames:
+        stat = os.stat(filename)
+        inputs[os.path.basename(filename)] = {
+            "bytes": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": file_checksum(filename),
+        }
+    return inputs
+
+
+def inputs_match(inputs: dict[str, dict], filenames: list[str]) -> bool:
+    """Check that ERA5 files are unchanged since era5_inputs recorded `inputs`.
+
+    A file with the recorded size and modification time is taken as unchanged,
+    so the checksum is only computed for files that were touched or replaced.
+
+    Args:
+        inputs (dict[str, dict]): Record returned by era5_inputs
+        filenames (list[str]): ERA5 files to check
+
+    Returns:
+        bool: True if every file is in the record with the same content
+    """
+    for filename in filenames:
+        entry = inputs.get(os.path.basename(filename))
+        if entry is None:
+            return False
+        stat = os.stat(filename)
+        if entry["bytes"] != stat.st_size:
+            return False
+        if entry["mtime_ns"] == stat.st_mtime_ns:
+            continue
+        if entry["sha256"] != file_checksum(filename):
+            return False
+    return True
+
+
+def _normalize(value):
+    """Return `value` with numbers as floats and times as ISO strings for hashing"""
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return float(value)
+    if isinstance(value, (datetime.date, np.datetime64)):
+        return pd.Timestamp(value).isoformat()
+    if isinstance(value, dict):
+        return {str(key): _normalize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_normalize(item) for item in value]
+    return value
+
+
+def factor_key(**parts) -> str:
+    """Return the cache key of a capacity factor.
+
+    Numbers are compared as floats and times by their ISO format, so e.g. 100 and
+    100.0, or a Timestamp and the equivalent datetime, give the same key.
+
+    Args:
+        **parts: Everything the factor depends on, e.g. technology, latitude,
+            longitude, model parameters and the ERA5 fingerprint
+
+    Returns:
+        str: Hexadecimal digest used as the file name of the entry
+    """
+    content = json.dumps(_normalize(parts), sort_keys=True, default=str)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def load_factors(cache_folder: str, keys: list[str]) -> dict[int, pd.Series]:
+    """Load the cached capacity factors of the given keys.
+
+    Args:
+        cache_folder (str): Folder of the cache
+        keys (list[str]): Cache key of each site or group
+
+    Returns:
+        dict[int, pd.Series]: Capacity factor of each position in `keys` that is cached
+    """
+    factors = {}
+    for position, key in enumerate(keys):
+        filename = os.path.join(cache_folder, f"{key}.npz")
+        if not os.path.exists(filename):
+            continue
+        with np.load(filename) as entry:
+            index = pd.to_datetime(entry["times"], utc=True).tz_convert(
+                str(entry["timezone"])
+            )
+            index.name = str(entry["index_name"]) or None
+            factors[position] = pd.Series(entry["values"], index=index)
+        # Mark the entry as recently used for eviction
+        os.utime(filename)
+    return factors
+
+
+def save_factor(cache_folder: str, key: str, factor: pd.Series) -> None:
+    """Save a capacity factor with a timezone-aware index to the cache.
+
+    Args:
+        cache_folder (str): Folder of the cache
+        key (str): Cache key returned by factor_key
+        factor (pd.Series): Hourly capacity factor
+    """
+    os.makedirs(cache_folder, exist_ok=True)
+    filename = os.path.join(cache_folder, f"{key}.npz")
+    # Write to a temporary file first so an interrupted run leaves no partial entry
+    temp_filename = f"{filename}.{os.getpid()}.tmp"
+    with open(temp_filename, "wb") as file:
+        np.savez(
+            file,
+            values=factor.to_numpy(dtype=np.float64),
+            times=factor.index.tz_convert("UTC").tz_localize(None).asi8,
+            timezone=str(factor.index.tz),
+            index_name=factor.index.name or "",
+        )
+    os.replace(temp_filename, filename)
+
+
+def evict_cache(cache_folder: str, max_cache_bytes: int) -> None:
+    """Remove the least recently used entries until the cache fits in `max_cache_bytes`.
+
+    Args:
+        cache_folder (str): Folder of the cache
+        max_cache_bytes (int): Maximum total size of the cache in bytes
+    """
+    if not os.path.exists(cache_folder):
+        return
+    entries = []
+    for entry in os.scandir(cache_folder):
+        if entry.name.endswith(".npz"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_bytes <= max_cache_bytes:
+            break
+        os.remove(path)
+        total_bytes -= size
+
+
+def clear_cache(cache_folder: str, keys: list[str] | None = None) -> None:
+    """Invalidate cached capacity factors.
+
+    Args:
+        cache_folder (str): Folder of the cache
+        keys (list[str], optional): Entries to remove. Defaults to None, which removes all entries
+    """
+    if not os.path.exists(cache_folder):
+        return
+    if keys is None:
+        keys = [
+            name[: -len(".npz")]
+            for name in os.listdir(cache_folder)
+            if name.endswith(".npz")
+        ]
+    for key in keys:
+        filename = os.path.join(cache_folder, f"{key}.npz")
+        if os.path.exists(filename):
+            os.remove(filename)
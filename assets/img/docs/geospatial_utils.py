@@ -1,15 +1,19 @@
 """ This module contains utility functions for processing geospatial data (transmission lines and substations).
 """
 
+import concurrent.futures
+
 import geopandas as gpd
 from networkx import Graph, connected_components
 import numpy as np
 import pandas as pd
-from shapely.geometry import LineString, Point
-from shapely.ops import split
-from scipy.spatial import cKDTree
+import shapely
+from shapely.geometry import LineString
+from scipy.spatial import Delaunay, QhullError
 from sklearn.cluster import DBSCAN
 
+from nearest_point import BusIndex, ckdnearest, point_coords
+
 EPSG_CRS = 3857  # Web Mercator
 
 
@@ -26,42 +30,6 @@ def get_source_sink(linestring: LineString) -> tuple:
     return linestring.boundary.geoms[0], linestring.boundary.geoms[1]
 
 
-def ckdnearest(
-    gdf_A: gpd.GeoDataFrame, gdf_B: gpd.GeoDataFrame, loc_col_A: str, loc_col_B: str
-) -> tuple[pd.Series, pd.Series]:
-    """Finds the nearest point in `gdf_B` for each point in `gdf_A` using a cKDTree.
-
-    This function efficiently computes the nearest neighbor between two GeoDataFrames
-    using a cKDTree for optimized spatial searching.
-
-    Source: https://gis.stackexchange.com/questions/222315/finding-nearest-point-in-other-geodataframe-using-geopandas
-
-    Args:
-        gdf_A (gpd.GeoDataFrame): The GeoDataFrame containing the points to find nearest neighbors for.
-        gdf_B (gpd.GeoDataFrame): The GeoDataFrame containing the potential nearest neighbors.
-        loc_col_A (str): The name of the geometry column in `gdf_A`.
-        loc_col_B (str): The name of the geometry column in `gdf_B`.
-
-    Returns:
-        tuple[pd.Series, pd.Series]: A tuple containing:
-            - A Series with the distances to the nearest neighbors.
-            - A Series with the 'id' column of the nearest points from `gdf_B`.
-
-    Example:
-        >>> distances, nearest_points = ckdnearest(gdf_points, gdf_stations, 'geometry', 'geometry')
-        >>> print(distances.head())
-        >>> print(nearest_points.head())
-    """
-
-    array_A = np.array(list(gdf_A[loc_col_A].apply(lambda x: (x.x, x.y))))
-    array_B = np.array(list(gdf_B[loc_col_B].apply(lambda x: (x.x, x.y))))
-    btree = cKDTree(array_B)
-    dist, idx = btree.query(array_A, k=1)
-    gdf_B_nearest = gdf_B.id.iloc[idx].drop(columns=loc_col_B).reset_index(drop=True)
-    dist = pd.Series(dist, name="dist")
-    return dist, gdf_B_nearest
-
-
 def assign_cluster(buses: gpd.GeoDataFrame, distance: float) -> np.ndarray:
     """
     Assigns clusters to substations using DBSCAN.
@@ -79,7 +47,7 @@ def assign_cluster(buses: gpd.GeoDataFrame, distance: float) -> np.ndarray:
     buses_proj = buses.to_crs(epsg=EPSG_CRS)  # Example: UTM Zone 18N
 
     # Extract coordinates for DBSCAN
-    coords = buses_proj["geometry"].apply(lambda geom: (geom.x, geom.y)).tolist()
+    coords = point_coords(buses_proj["geometry"])
 
     # Apply DBSCAN clustering
     dbscan = DBSCAN(eps=distance, min_samples=2)  # eps is the distance parameter
@@ -151,47 +119,122 @@ def keep_distant_points(points, lines, distance):
     return distant_points.to_crs(points.crs)
 
 
-def _split_line_at_point(
-    line: LineString, point: Point
-) -> tuple[LineString, LineString]:
-    # Create a short line segment that intersects the original line for more
-    # robust splitting because our linestring can be complex
-    splitting_line1 = LineString(
-        [
-            (point.x - 1e-2, point.y),  # Point slightly to the left
-            (point.x + 1e-2, point.y),  # Point slightly to the right
-        ]
+def _split_line_at_distances(
+    line: LineString, distances: np.ndarray, tolerance: float = 1e-6
+) -> list[LineString]:
+    """
+    Splits a line at several distances from its start in a single pass.
+
+    Args:
+      line: A shapely LineString geometry
+      distances: Sorted distances along the line where it is cut
+      tolerance: Cuts closer than this to the ends of the line or to the
+                 previous cut are skipped
+
+    Returns:
+      The segments of the line from its start to its end.
+    """
+    coords = shapely.get_coordinates(line)
+    # Distance of each vertex from the start of the line
+    vertex_distances = np.concatenate(
+        [[0], np.cumsum(np.hypot(*np.diff(coords, axis=0).T))]
+    )
+    length = vertex_distances[-1]
+
+    # Skip the cuts at the start or end of the line and the repeated cuts
+    cuts = distances[(distances > tolerance) & (distances < length - tolerance)]
+    cuts = cuts[np.diff(cuts, prepend=-np.inf) > tolerance]
+    bounds = np.concatenate([[0], cuts, [length]])
+    bound_coords = shapely.get_coordinates(shapely.line_interpolate_point(line, bounds))
+    bound_coords[[0, -1]] = coords[[0, -1]]
+
+    # Each segment is made of its bounds and the vertices between them, leaving out
+    # the vertices within the tolerance of a bound
+    first_vertices = np.searchsorted(
+        vertex_distances, bounds[:-1] + tolerance, side="right"
+    )
+    last_vertices = np.searchsorted(
+        vertex_distances, bounds[1:] - tolerance, side="left"
+    )
+    return [
+        LineString(
+            np.vstack([bound_coords[i], coords[first:last], bound_coords[i + 1]])
+        )
+        for i, (first, last) in enumerate(zip(first_vertices, last_vertices))
+    ]
+
+
+def _split_lines_chunk(
+    lines: gpd.GeoDataFrame, bus_geoms: np.ndarray, filter_distance: int
+) -> pd.DataFrame:
+    """
+    Splits projected power lines at the substations within the filter distance.
+
+    Args:
+      lines: A GeoDataFrame of power lines in EPSG_CRS
+      bus_geoms: Point geometries of the substations in EPSG_CRS
+      filter_distance: The maximum distance between a line and a substation
+
+    Returns:
+      The segments of the lines, indexed by the index of their original line.
+    """
+    # Get all pairs of lines and substations within the filter distance at once
+    line_geoms = lines.geometry.values
+    line_positions, bus_positions = shapely.STRtree(bus_geoms).query(
+        line_geoms, predicate="dwithin", distance=filter_distance
     )
-    # If splitting_line overlaps with the line, then use the y-axis instead
-    splitting_line2 = LineString(
-        [
-            (point.x, point.y - 1e-2),  # Point slightly below
-            (point.x, point.y + 1e-2),  # Point slightly above
-        ]
+
+    # Distance of the substations from the start of their line
+    distances = shapely.line_locate_point(
+        line_geoms[line_positions], bus_geoms[bus_positions]
     )
+    order = np.lexsort((distances, line_positions))
+    line_positions, distances = line_positions[order], distances[order]
+
+    # Only the lines with substations nearby are split, each at all its cuts at once
+    overpassing, first_buses = np.unique(line_positions, return_index=True)
+    split_geoms = [
+        _split_line_at_distances(line_geoms[position], line_distances)
+        for position, line_distances in zip(
+            overpassing, np.split(distances, first_buses[1:])
+        )
+    ]
 
-    try:
-        split_line = split(line, splitting_line1)
-    except ValueError as e:
-        if "Input geometry segment overlaps with the splitter" not in str(e):
-            raise e
-        split_line = split(line, splitting_line2)
+    # Repeat the attributes of each split line for all its segments
+    columns = ["name", "max_voltage", "circuits", "cables", "id", "geometry"]
+    number_segments = np.array([len(segments) for segments in split_geoms], dtype=int)
+    split_lines = lines.iloc[np.repeat(overpassing, number_segments)][columns]
+    split_numbers = np.arange(len(split_lines)) - np.repeat(
+        np.cumsum(number_segments) - number_segments, number_segments
+    )
+    split_lines["name"] = [
+        f"{line_id}-split-{number}"
+        for line_id, number in zip(split_lines["id"], split_numbers)
+    ]
+    split_lines["geometry"] = [
+        segment for segments in split_geoms for segment in segments
+    ]
 
-    if len(split_line.geoms) == 1:
-        return None
-    return split_line.geoms[0], split_line.geoms[1]
+    # Lines without substations nearby are kept as they are, in their original order
+    unsplit = np.ones(len(lines), dtype=bool)
+    unsplit[overpassing] = False
+    return pd.concat([lines[unsplit][columns], split_lines]).sort_index(kind="stable")
 
 
 def split_overpassing_lines(
-    lines: gpd.GeoDataFrame, buses: gpd.GeoDataFrame, filter_distance: int
+    lines: gpd.GeoDataFrame,
+    buses: gpd.GeoDataFrame,
+    filter_distance: int,
+    workers: int = 1,
 ):
     """Splits power lines that overpass substations within a specified distance.
 
-    This function iterates through power lines and splits them at the points where they
-    overpass substations. It considers a `filter_distance` to account for cases where
-    substations may not be exactly on the lines. The splitting is performed sequentially
-    along each line, ensuring that the resulting segments maintain the original line's
-    attributes.
+    This function finds all pairs of power lines and substations within `filter_distance`
+    with a single spatial index query, and splits the lines at the points where they
+    overpass substations. The `filter_distance` accounts for cases where substations may
+    not be exactly on the lines. Each line is cut at all the projected substations at
+    once by linear referencing, ensuring that the resulting segments maintain the
+    original line's attributes. Lines without substations nearby are kept unchanged.
 
     Args:
         lines (gpd.GeoDataFrame): A GeoDataFrame of power lines, with a 'geometry' column
@@ -200,6 +243,8 @@ def split_overpassing_lines(
                                  containing Point geometries.
         filter_distance (int): The maximum distance (in meters) between a line and a
                                substation for the line to be considered "overpassing".
+        workers (int, optional): Number of worker processes. Defaults to 1, which runs
+                                 serially. The result does not depend on it.
 
     Returns:
         gpd.GeoDataFrame: A new GeoDataFrame containing the split power lines. Each
@@ -212,94 +257,52 @@ def split_overpassing_lines(
         - The function reprojects the geometries to UTM (EPSG:32618) for accurate
           distance calculations and then converts them back to the original CRS.
     """
-    split_lines = []
-
     # Convert crs to UTM for distance calculations
     line_crs = lines.crs
-    lines_copy = lines.copy().to_crs(epsg=EPSG_CRS)
+    lines_copy = lines.copy().to_crs(epsg=EPSG_CRS).reset_index(drop=True)
     buses_copy = buses.copy().to_crs(epsg=EPSG_CRS)
+    bus_geoms = buses_copy.geometry.values
 
-    # Iterate over the lines
-    for _, line in lines_copy.iterrows():
-        # Extract line spec to copy to the split lines
-        name = line.name
-        max_voltage = line.max_voltage
-        circuits = line.circuits
-        cables = line.cables
-        line_id = line.id
-
-        # Get the closest substations within the filter distance
-        closest_buses = buses_copy.loc[
-            buses_copy.geometry.distance(line.geometry) <= filter_distance
-        ].copy()
-
-        # If no substations are within the filter distance, keep the original line
-        if closest_buses.empty:
-            split_lines.append(
-                {
-                    "name": name,
-                    "max_voltage": max_voltage,
-                    "circuits": circuits,
-                    "cables": cables,
-                    "id": line_id,
-                    "geometry": line.geometry,
-                }
-            )
-            continue
-
-        # Reorder the substations based on the distance from the start of the line
-        closest_buses["distance"] = closest_buses.geometry.apply(
-            lambda x: line.geometry.project(x)
-        )
-        closest_buses = closest_buses.sort_values("distance")
-
-        # For each substation in the list, keep splitting the linestring
-        current_segment = line.geometry
-        number_split = 0
-        for _, bus_row in closest_buses.iterrows():
-            # Split the line at the projected point
-            point_to_split = current_segment.interpolate(
-                current_segment.project(bus_row.geometry)
-            )
-
-            # Skip if the point is at the start or end of the line
-            if point_to_split.equals_exact(
-                current_segment.boundary.geoms[0], tolerance=1e-6
-            ) or point_to_split.equals_exact(
-                current_segment.boundary.geoms[1], tolerance=1e-6
-            ):
-                continue
-            split_line = _split_line_at_point(current_segment, point_to_split)
-
-            # Otherwise, the line is splitted into two line segments
-            line_a, current_segment = split_line
-
-            split_lines.append(
-                {
-                    "name": f"{line_id}-split-{number_split}",
-                    "max_voltage": max_voltage,
-                    "circuits": circuits,
-                    "cables": cables,
-                    "id": line_id,
-                    "geometry": line_a,
-                }
-            )
-            number_split += 1
-        # Append the last segment of the line
-        split_lines.append(
-            {
-                "name": f"{line_id}-split-{number_split}",
-                "max_voltage": max_voltage,
-                "circuits": circuits,
-                "cables": cables,
-                "id": line_id,
-                "geometry": current_segment,
-            }
-        )
-    output = gpd.GeoDataFrame(split_lines, crs=lines_copy.crs).to_crs(line_crs)
+    if workers <= 1 or lines_copy.empty:
+        output = _split_lines_chunk(lines_copy, bus_geoms, filter_distance)
+    else:
+        # Nearby lines go to the same chunk so that each chunk needs few substations
+        order = np.argsort(lines_copy.geometry.hilbert_distance(), kind="stable")
+        chunks = np.array_split(order, min(len(order), workers * 4))
+        bus_tree = shapely.STRtree(bus_geoms)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for chunk in chunks:
+                chunk_lines = lines_copy.iloc[chunk]
+                # Only send the substations near the bounding box of the chunk
+                min_x, min_y, max_x, max_y = chunk_lines.total_bounds
+                chunk_buses = np.sort(
+                    bus_tree.query(
+                        shapely.box(
+                            min_x - filter_distance,
+                            min_y - filter_distance,
+                            max_x + filter_distance,
+                            max_y + filter_distance,
+                        )
+                    )
+                )
+                futures.append(
+                    executor.submit(
+                        _split_lines_chunk,
+                        chunk_lines,
+                        bus_geoms[chunk_buses],
+                        filter_distance,
+                    )
+                )
+            output = pd.concat([future.result() for future in futures])
+        output = output.sort_index(kind="stable")
+
+    output = gpd.GeoDataFrame(output.reset_index(drop=True), crs=lines_copy.crs).to_crs(
+        line_crs
+    )
     # Recover all the original columns -- including source and sink
-    output["source"] = output.geometry.apply(lambda x: get_source_sink(x)[0])
-    output["sink"] = output.geometry.apply(lambda x: get_source_sink(x)[1])
+    output["source"] = shapely.get_point(output.geometry.values, 0)
+    output["sink"] = shapely.get_point(output.geometry.values, -1)
     return output
 
 
@@ -436,16 +439,14 @@ def extend_line_to_bus(
     Returns:
         A GeoDataFrame of lines with end points connected to their nearest buses.
     """
-    _, source_nearest = ckdnearest(
-        lines, clustered_buses, loc_col_A="source", loc_col_B="geometry"
-    )
-    _, sink_nearest = ckdnearest(
-        lines, clustered_buses, loc_col_A="sink", loc_col_B="geometry"
-    )
+    # One index answers the queries of both ends
+    bus_index = BusIndex(clustered_buses)
+    _, source_nearest = bus_index.nearest(lines["source"])
+    _, sink_nearest = bus_index.nearest(lines["sink"])
 
     lines_copy = lines.copy()
-    lines_copy["source_bus"] = source_nearest
-    lines_copy["sink_bus"] = sink_nearest
+    lines_copy["source_bus"] = bus_index.ids[source_nearest]
+    lines_copy["sink_bus"] = bus_index.ids[sink_nearest]
 
     lines_copy["source_bus_loc"] = lines_copy["source_bus"].map(
         clustered_buses.set_index("id")["geometry"]
@@ -553,77 +554,148 @@ def get_lines_to_isolated_buses(
     return fake_line_gdf
 
 
+def _candidate_edges(coords: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the pairs of buses that can be the shortest link between two groups.
+
+    The shortest link from a group of buses to the other buses has no other bus in
+    the circle with the link as diameter, so it is an edge of the Delaunay
+    triangulation. Small or collinear sets of buses fall back to every pair.
+
+    Args:
+        coords: An (n x 2) array of bus coordinates.
+
+    Returns:
+        A tuple of two arrays with the positions of the buses at both ends of each edge.
+    """
+    try:
+        if len(coords) < 3:
+            raise QhullError("At least three buses are needed for a triangulation")
+        simplices = Delaunay(coords).simplices
+        edges = np.vstack(
+            [simplices[:, [0, 1]], simplices[:, [1, 2]], simplices[:, [0, 2]]]
+        )
+        edges = np.unique(np.sort(edges, axis=1), axis=0)
+    except QhullError:
+        edges = np.column_stack(np.triu_indices(len(coords), k=1))
+    return edges[:, 0], edges[:, 1]
+
+
+def _find_root(parents: np.ndarray, node: int) -> int:
+    """Returns the root of a node of a union-find forest, halving the path."""
+    while parents[node] != node:
+        parents[node] = parents[parents[node]]
+        node = parents[node]
+    return node
+
+
+def _find_roots(parents: np.ndarray) -> np.ndarray:
+    """Returns the root of every node of a union-find forest, compressing the paths."""
+    while True:
+        grandparents = parents[parents]
+        if np.array_equal(grandparents, parents):
+            return parents
+        parents[:] = grandparents
+
+
 def connect_subgraphs(
-    lines: gpd.GeoDataFrame, clustered_buses: gpd.GeoDataFrame, current_iter_num: int
-) -> list[dict]:
-    """Identifies and connects disconnected subgraphs in the network.
+    lines: gpd.GeoDataFrame, clustered_buses: gpd.GeoDataFrame
+) -> gpd.GeoDataFrame:
+    """Connects the disconnected subgraphs of the network in a single call.
+
+    Like Borůvka's algorithm for minimum spanning forests, every subgraph is linked to
+    the nearest bus outside of it, the linked subgraphs are merged with a union-find,
+    and this repeats until the network is connected. A bus that is not on any line
+    joins the subgraph linked to it. Candidate links are the edges of the Delaunay
+    triangulation of the buses, computed once.
 
     Args:
         lines: A GeoDataFrame of transmission lines.
         clustered_buses: A GeoDataFrame of clustered bus locations.
-        current_iter_num: The current iteration number. Multiple iterations may be needed to connect all subgraphs.
 
     Returns:
-        A list of dictionaries containing information about the connecting lines.
+        A GeoDataFrame of the lines connecting the subgraphs, without duplicates.
     """
-
     # 1. Identify disconnected subgraphs
     graph = lines[["source_bus", "sink_bus"]].values.tolist()
 
     G = Graph(graph)
     subgraphs = list(connected_components(G))
 
-    if len(subgraphs) > 1:
-        print(
-            f"Round {current_iter_num}: Found {len(subgraphs)} disconnected subgraphs."
-        )
+    # Every bus starts as its own set, then the buses of each subgraph are merged.
+    # Buses of the lines that are not in clustered_buses are skipped.
+    bus_subgraphs = {
+        bus: number for number, subgraph in enumerate(subgraphs) for bus in subgraph
+    }
+    bus_ids = clustered_buses["id"].values
+    subgraph_of = pd.Series(bus_ids).map(bus_subgraphs)
+    members = np.flatnonzero(subgraph_of.notna().values)
+    # The first bus of each subgraph is the root of its set
+    roots = (
+        pd.Series(members)
+        .groupby(subgraph_of.values[members].astype(int))
+        .transform("min")
+        .values
+    )
+    parents = np.arange(len(bus_ids))
+    parents[members] = roots
+    # Only sets with buses on lines must be connected
+    on_lines = np.zeros(len(bus_ids), dtype=bool)
+    on_lines[roots] = True
 
-        # 2. For each subgraph, find its nearest neighboring subgraph
-        connecting_lines = []
-        for idx, subgraph in enumerate(subgraphs):
-            # First seperate buses in the subgraph from the rest
-            subgraph_buses = clustered_buses[
-                clustered_buses["id"].isin(subgraph)
-            ].reset_index(drop=True)
-
-            other_buses = clustered_buses[
-                ~clustered_buses["id"].isin(subgraph)
-            ].reset_index(drop=True)
-
-            dist, nearest_buses = ckdnearest(
-                subgraph_buses,
-                other_buses,
-                loc_col_A="geometry",
-                loc_col_B="geometry",
-            )
-
-            # Find the nearest bus in the subgraph
-            subgraph_bus_idx = dist.idxmin()
-            subgraph_bus = subgraph_buses.loc[subgraph_bus_idx, "id"]
-            nearest_bus = nearest_buses.loc[subgraph_bus_idx]
-
-            # Connect the subgraph to its neighbor
-            start_point = subgraph_buses.loc[subgraph_bus_idx, "geometry"]
-            end_point = other_buses.set_index("id").loc[nearest_bus, "geometry"]
-
-            connecting_line = LineString([start_point, end_point])
-
-            if connecting_line not in connecting_lines:
-                connecting_lines.append(
-                    {
-                        "id": f"subgraph{idx}-{current_iter_num}",
-                        "max_voltage": max(
-                            subgraph_buses.loc[subgraph_bus_idx, "max_voltage"],
-                            other_buses.set_index("id").loc[nearest_bus, "max_voltage"],
-                        ),
-                        "source_bus": subgraph_bus,
-                        "sink_bus": nearest_bus,
-                        "source": start_point,
-                        "sink": end_point,
-                        "geometry": connecting_line,
-                    }
+    connecting_lines = []
+    if len(subgraphs) > 1:
+        print(f"Found {len(subgraphs)} disconnected subgraphs.")
+        coords = point_coords(clustered_buses["geometry"])
+        edge_a, edge_b = _candidate_edges(coords)
+        # Each edge can link the set of either of its buses to the other bus
+        sources = np.concatenate([edge_a, edge_b])
+        sinks = np.concatenate([edge_b, edge_a])
+        lengths = np.linalg.norm(coords[sources] - coords[sinks], axis=1)
+        # Sorting once lets each round take the first link of every set
+        order = np.lexsort((sinks, sources, lengths))
+        sources, sinks = sources[order], sinks[order]
+
+        while True:
+            roots = _find_roots(parents)
+            if len(np.unique(roots[on_lines[roots]])) <= 1:
+                break
+
+            # 2. The shortest link of every set with buses on lines
+            outgoing = (roots[sources] != roots[sinks]) & on_lines[roots[sources]]
+            if not outgoing.any():
+                break
+            _, first = np.unique(roots[sources[outgoing]], return_index=True)
+            links = np.flatnonzero(outgoing)[np.sort(first)]
+
+            # 3. Merge the linked sets, skipping links between sets that were just merged
+            for source, sink in zip(sources[links], sinks[links]):
+                source_root = _find_root(parents, source)
+                sink_root = _find_root(parents, sink)
+                if source_root == sink_root:
+                    continue
+                parents[sink_root] = source_root
+                on_lines[source_root] |= on_lines[sink_root]
+                connecting_lines.append((source, sink))
+
+    source_buses = clustered_buses.iloc[[source for source, _ in connecting_lines]]
+    sink_buses = clustered_buses.iloc[[sink for _, sink in connecting_lines]]
+    return gpd.GeoDataFrame(
+        {
+            "id": [f"subgraph{i}" for i in range(len(connecting_lines))],
+            "max_voltage": np.maximum(
+                source_buses["max_voltage"].values, sink_buses["max_voltage"].values
+            ),
+            "source_bus": source_buses["id"].values,
+            "sink_bus": sink_buses["id"].values,
+            "source": list(source_buses["geometry"]),
+            "sink": list(sink_buses["geometry"]),
+            "geometry": [
+                LineString([start, end])
+                for start, end in zip(
+                    source_buses["geometry"].values, sink_buses["geometry"].values
                 )
-    else:
-        print(f"Round {current_iter_num}: No disconnected subgraphs found.")
-        connecting_lines = []
-    return connecting_lines
+            ],
+        },
+        geometry="geometry",
+        crs=lines.crs,
+    )
@@ -1,10 +1,75 @@
 import os
 import concurrent.futures
+import functools
+import hashlib
+import json
+import queue
+import tempfile
+import threading
+import time
+import zipfile
+from typing import Callable
 
 import geopandas as gpd
+import numpy as np
 import pandas as pd
+import requests
+import xarray as xr
 import cdsapi
 from datetime import datetime as dt
+from scipy.cluster.hierarchy import fcluster, linkage
+
+from factor_cache import era5_inputs, file_checksum, inputs_match
+
+ERA5_DATASET = "reanalysis-era5-single-levels"
+
+# CDS rejects requests with too many items (one item is one variable at one hour)
+MAX_REQUEST_ITEMS = 60000
+# Items of one variable for one month, as every request asks for 31 days
+ITEMS_PER_MONTH = 31 * 24
+
+# Names of the ERA5 variables inside the downloaded netCDF files. Newer CDS
+# files use the 'avg_' names for mean rates.
+ERA5_SHORT_NAMES = {
+    "100m_u_component_of_wind": ("u100",),
+    "100m_v_component_of_wind": ("v100",),
+    "10m_u_component_of_wind": ("u10",),
+    "10m_v_component_of_wind": ("v10",),
+    "forecast_surface_roughness": ("fsr",),
+    "surface_pressure": ("sp",),
+    "2m_temperature": ("t2m",),
+    "mean_surface_direct_short_wave_radiation_flux": ("msdrswrf", "avg_sdirswrf"),
+    "mean_surface_downward_short_wave_radiation_flux": ("msdwswrf", "avg_sdswrf"),
+}
+
+# The netCDF library is not thread-safe, so parallel downloads split their files one at a time
+_NETCDF_LOCK = threading.Lock()
+
+# CDS limits the number of running requests per user
+MAX_CONCURRENT_REQUESTS = 4
+
+
+class IncompleteDownloadError(IOError):
+    """A downloaded file that cannot be read, e.g. after a dropped transfer"""
+
+
+# Failures worth retrying: dropped connections, timeouts and broken files. Server
+# errors are retried by is_transient. Local errors, e.g. a full disk, are not.
+TRANSIENT_ERRORS = (
+    ConnectionError,
+    TimeoutError,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    IncompleteDownloadError,
+)
+
+# Each download folder keeps a manifest of the request, size and checksum of its files
+MANIFEST_NAME = "era5_manifest.json"
+_MANIFEST_LOCK = threading.Lock()
+
+# Attribute of a merged file with the size and checksum of the monthly files it was made from
+INPUTS_ATTRIBUTE = "era5_inputs"
 
 
 def get_bbox(
@@ -31,6 +96,54 @@ def get_bbox(
     return bbox
 
 
+def get_bboxes(
+    df: pd.DataFrame,
+    max_distance: float = 1.0,
+    buffer_size: float = 0.25,
+    resolution: float = 0.25,
+) -> list[tuple[float, float, float, float]]:
+    """Get tight bounding boxes around clusters of sites
+
+    Sites closer than `max_distance` degrees (in latitude and longitude) are chained
+    into one cluster. Each box is snapped to the ERA5 grid and contains the nearest
+    grid cell of its sites plus `buffer_size`. With max_distance=0 and buffer_size=0,
+    each box is the exact grid cell of its sites.
+
+    Args:
+        df (pd.DataFrame): DataFrame with columns 'latitude' and 'longitude'
+        max_distance (float, optional): Largest gap (degrees) between sites of a cluster. Defaults to 1.0
+        buffer_size (float, optional): Buffer size (degrees) around each box. Defaults to 0.25 degrees
+        resolution (float, optional): Resolution (degrees) of the ERA5 grid. Defaults to 0.25 degrees
+
+    Returns:
+        list[tuple[float, float, float, float]]: Bounding box coordinates of each cluster,
+        ordering as max_y, min_x, min_y, max_x
+    """
+    # Nearest grid cell of each site
+    cells = np.unique(
+        np.round(df[["latitude", "longitude"]].to_numpy(dtype=float) / resolution),
+        axis=0,
+    ).astype(int)
+    if len(cells) == 1:
+        clusters = np.ones(1, dtype=int)
+    else:
+        # Single linkage with the Chebyshev distance chains sites into boxes
+        clusters = fcluster(
+            linkage(cells * resolution, method="single", metric="chebyshev"),
+            t=max_distance,
+            criterion="distance",
+        )
+
+    buffer_cells = int(np.ceil(buffer_size / resolution))
+    bboxes = []
+    for cluster in np.unique(clusters):
+        cluster_cells = cells[clusters == cluster]
+        min_y, min_x = (cluster_cells.min(axis=0) - buffer_cells) * resolution
+        max_y, max_x = (cluster_cells.max(axis=0) + buffer_cells) * resolution
+        bboxes.append([float(max_y), float(min_x), float(min_y), float(max_x)])
+    return bboxes
+
+
 def get_variables(target_renewable: str) -> dict[str, str]:
     """Return ERA5 variables for the target renewable energy source
 
@@ -63,13 +176,143 @@ def get_variables(target_renewable: str) -> dict[str, str]:
         )
 
 
+def era5_request(
+    era5_variables: list[str],
+    year: str,
+    months: list[str],
+    bbox: tuple[float, float, float, float],
+) -> dict:
+    """Return the CDS request for hourly data of the given variables and months of a year"""
+    return {
+        "product_type": ["reanalysis"],
+        "variable": list(era5_variables),
+        "year": [year],
+        "month": list(months),
+        "day": [str(i).zfill(2) for i in range(1, 32)],
+        "time": [f"{i:02}:00" for i in range(24)],
+        "data_format": "netcdf",
+        "area": bbox,  # North, West, South, East
+    }
+
+
+def load_manifest(download_folder: str) -> dict[str, dict]:
+    """Load the manifest of a download folder.
+
+    Args:
+        download_folder (str): Path of the downloaded files
+
+    Returns:
+        dict[str, dict]: The 'request', 'bytes' and 'sha256' of each file name
+    """
+    manifest_file = os.path.join(download_folder, MANIFEST_NAME)
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as file:
+        return json.load(file)
+
+
+def record_download(filename: str, request: dict) -> None:
+    """Add a downloaded file to the manifest of its folder.
+
+    Args:
+        filename (str): Downloaded file
+        request (dict): CDS request of the file, as returned by era5_request
+    """
+    entry = {
+        "request": json.loads(json.dumps(request)),
+        "bytes": os.path.getsize(filename),
+        "sha256": file_checksum(filename),
+    }
+    download_folder = os.path.dirname(filename) or "."
+    manifest_file = os.path.join(download_folder, MANIFEST_NAME)
+    with _MANIFEST_LOCK:
+        manifest = load_manifest(download_folder)
+        manifest[os.path.basename(filename)] = entry
+        # Replace the manifest atomically so an interrupted run cannot corrupt it
+        with open(f"{manifest_file}.tmp", "w") as file:
+            json.dump(manifest, file, indent=1, sort_keys=True)
+        os.replace(f"{manifest_file}.tmp", manifest_file)
+
+
+def _is_readable(filename: str) -> bool:
+    """Check that a netCDF file opens and that its last time step can be read"""
+    try:
+        with _NETCDF_LOCK, xr.open_dataset(filename) as dataset:
+            time_dim = "valid_time" if "valid_time" in dataset.dims else "time"
+            for variable in dataset.data_vars.values():
+                if time_dim in variable.dims:
+                    variable.isel({time_dim: -1}).values
+    except Exception:
+        return False
+    return True
+
+
+def check_download(filename: str, request: dict, manifest: dict[str, dict]) -> bool:
+    """Check that a file exists and matches its manifest entry.
+
+    Files downloaded before the manifest existed have no entry. They are kept
+    if they can be read, and added to the manifest.
+
+    Args:
+        filename (str): Downloaded file
+        request (dict): CDS request of the file, as returned by era5_request
+        manifest (dict[str, dict]): Manifest returned by load_manifest
+
+    Returns:
+        bool: True if the file is complete, False if it must be downloaded
+    """
+    if not os.path.exists(filename):
+        return False
+
+    entry = manifest.get(os.path.basename(filename))
+    if entry is None:
+        if not _is_readable(filename):
+            return False
+        record_download(filename, request)
+        return True
+
+    # The size check is cheap, so the checksum is computed only when it passes
+    return (
+        entry["request"] == json.loads(json.dumps(request))
+        and entry["bytes"] == os.path.getsize(filename)
+        and entry["sha256"] == file_checksum(filename)
+    )
+
+
+def verify_downloads(
+    downloads: dict[str, dict], download_folder: str, workers: int = 8
+) -> list[str]:
+    """Return the files that are missing, corrupt or downloaded for another request.
+
+    Args:
+        downloads (dict[str, dict]): CDS request of each file, as returned by expected_downloads
+        download_folder (str): Path of the downloaded files
+        workers (int, optional): Number of files checked in parallel. Defaults to 8
+
+    Returns:
+        list[str]: Files to download
+    """
+    manifest = load_manifest(download_folder)
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        valid = list(
+            executor.map(
+                lambda item: check_download(*item, manifest), downloads.items()
+            )
+        )
+    invalid = [filename for filename, ok in zip(downloads, valid) if not ok]
+    print(f"Verified {len(downloads) - len(invalid)} of {len(downloads)} files.")
+    return invalid
+
+
 def download_data(
     era5_variable: str,
     month: str,
     year: str,
     bbox: tuple[float, float, float, float],
     output_folder: str,
-) -> None:
+    client: cdsapi.Client | None = None,
+    check_existing: bool = True,
+) -> int:
     """Write ERA5 data for a single variable and month as a netCDF file.
 
     Args:
@@ -78,14 +321,24 @@ def download_data(
         year (str): Year to download, e.g. '2019'
         bbox (tuple[float, float, float, float]): Bounding box coordinates, ordering as max_y, min_x, min_y, max_x
         output_folder (str): Path to save the downloaded file
+        client (cdsapi.Client, optional): Client to send the request. Defaults to None, which creates one
+        check_existing (bool, optional): Skip the download if an existing file matches the
+            manifest. Defaults to True. download_files passes False for the files that
+            verify_downloads already rejected, so they are not read and hashed twice
+
+    Returns:
+        int: Number of bytes downloaded
 
     """
     if type(month) == int:
         raise ValueError("Month should be a string, e.g. '01'")
 
-    if os.path.exists(output_folder):
+    request = era5_request([era5_variable], year, [month], bbox)
+
+    manifest = load_manifest(os.path.dirname(output_folder) or ".")
+    if check_existing and check_download(output_folder, request, manifest):
         print(f"File already exists: {output_folder}. Skipping download.")
-        return
+        return 0
 
     current_time = dt.now()
     print(
@@ -93,23 +346,451 @@ def download_data(
         current_time.strftime("%H:%M:%S"),
     )
 
-    request = {
-        "product_type": ["reanalysis"],
-        "variable": [era5_variable],
-        "year": [year],
-        "month": [month],
-        "day": [str(i).zfill(2) for i in range(1, 32)],
-        "time": [f"{i:02}:00" for i in range(24)],
-        "data_format": "netcdf",
-        "area": bbox,  # North, West, South, East
+    if client is None:
+        client = cdsapi.Client()
+    # Download to a temporary file so an interrupted download never looks complete
+    temp_file = f"{output_folder}.download"
+    client.retrieve(ERA5_DATASET, request, temp_file)
+    if not _is_readable(temp_file):
+        os.remove(temp_file)
+        raise IncompleteDownloadError(
+            f"Downloaded file is not valid netCDF: {output_folder}"
+        )
+    os.replace(temp_file, output_folder)
+    record_download(output_folder, request)
+
+    total_mins = round((dt.now() - current_time).seconds / 60, 2)
+    print(f"Completed downloading {era5_variable} for {month} in {total_mins} mins")
+    return os.path.getsize(output_folder)
+
+
+def _chunks(items: list, size: int) -> list[list]:
+    """Split a list into consecutive chunks of at most `size` items"""
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def expected_downloads(
+    era5_variables: dict[str, str],
+    year: str,
+    bbox: tuple[float, float, float, float],
+    download_folder: str,
+) -> dict[str, dict]:
+    """Return the monthly files of get_era5 and the CDS request of each file.
+
+    Args:
+        era5_variables (dict[str, str]): Dictionary of ERA5 variables for the target renewable energy source
+        year (str): Year to download, e.g. '2019'
+        bbox (tuple[float, float, float, float]): Bounding box coordinates, ordering as max_y, min_x, min_y, max_x
+        download_folder (str): Path to save the downloaded files
+
+    Returns:
+        dict[str, dict]: CDS request of each file, as returned by era5_request
+    """
+    # Months of the year plus month -1 and month +1, as (year, month, file label)
+    months = (
+        [(str(int(year) - 1), "12", "00")]
+        + [(year, f"{i:02d}", f"{i:02d}") for i in range(1, 13)]
+        + [(str(int(year) + 1), "01", "13")]
+    )
+    return {
+        f"{download_folder}/{name}_{label}.nc": era5_request(
+            [variable], request_year, [month], bbox
+        )
+        for variable, name in era5_variables.items()
+        for request_year, month, label in months
+    }
+
+
+def cached_downloads(
+    era5_variables: dict[str, str],
+    start_year: str,
+    end_year: str,
+    bbox: tuple[float, float, float, float],
+    cache_folder: str,
+) -> dict[str, dict]:
+    """Return the files of a multi-year cache and the CDS request of each file.
+
+    The cache holds one file per variable and month, named after the year and month,
+    e.g. '2m_temperature_2019_12.nc'. Consecutive years share their boundary months,
+    so every month is downloaded once however many runs use it.
+
+    Args:
+        era5_variables (dict[str, str]): Dictionary of ERA5 variables for the target renewable energy source
+        start_year (str): First year, e.g. '2019'
+        end_year (str): Last year (inclusive), e.g. '2023'
+        bbox (tuple[float, float, float, float]): Bounding box coordinates, ordering as max_y, min_x, min_y, max_x
+        cache_folder (str): Path of the cache
+
+    Returns:
+        dict[str, dict]: CDS request of each file, as returned by era5_request
+    """
+    # December before the first year and January after the last year cover the
+    # timezone offsets at the edges, as month -1 and month +1 of get_era5
+    month_starts = pd.date_range(
+        f"{int(start_year) - 1}-12-01", f"{int(end_year) + 1}-01-01", freq="MS"
+    )
+    return {
+        f"{cache_folder}/{name}_{month_start:%Y_%m}.nc": era5_request(
+            [variable], f"{month_start:%Y}", [f"{month_start:%m}"], bbox
+        )
+        for variable, name in era5_variables.items()
+        for month_start in month_starts
     }
 
-    client = cdsapi.Client()
-    dataset = "reanalysis-era5-single-levels"
-    client.retrieve(dataset, request, output_folder)
+
+def plan_requests(
+    era5_variables: dict[str, str],
+    year: str,
+    bbox: tuple[float, float, float, float],
+    download_folder: str,
+    max_items: int = MAX_REQUEST_ITEMS,
+) -> list[dict]:
+    """Merge the downloads of get_era5 into as few CDS requests as the size limit allows.
+
+    A CDS request covers every combination of its variables and months within one
+    year, so variables that miss the same months of a year are requested together.
+    Files that pass verify_downloads are left out.
+
+    Args:
+        era5_variables (dict[str, str]): Dictionary of ERA5 variables for the target renewable energy source
+        year (str): Year to download, e.g. '2019'
+        bbox (tuple[float, float, float, float]): Bounding box coordinates, ordering as max_y, min_x, min_y, max_x
+        download_folder (str): Path to save the downloaded files
+        max_items (int, optional): Maximum number of items per request. Defaults to MAX_REQUEST_ITEMS
+
+    Returns:
+        list[dict]: Each dict has the CDS 'request' and its 'outputs', which maps
+        (variable, month) of the request to the monthly file of the variable
+    """
+    downloads = expected_downloads(era5_variables, year, bbox, download_folder)
+    return merge_downloads(downloads, download_folder, max_items)
+
+
+def merge_downloads(
+    downloads: dict[str, dict],
+    download_folder: str,
+    max_items: int = MAX_REQUEST_ITEMS,
+) -> list[dict]:
+    """Merge the missing files of `downloads` into few CDS requests, as described in plan_requests.
+
+    Args:
+        downloads (dict[str, dict]): CDS request of each file, as returned by expected_downloads
+        download_folder (str): Path to save the downloaded files
+        max_items (int, optional): Maximum number of items per request. Defaults to MAX_REQUEST_ITEMS
+
+    Returns:
+        list[dict]: Each dict has the CDS 'request' and its 'outputs', which maps
+        (variable, month) of the request to the monthly file of the variable
+    """
+    # Missing files of each variable, grouped by the year of the request
+    missing = {}
+    for output_file in verify_downloads(downloads, download_folder):
+        request = downloads[output_file]
+        bbox = request["area"]
+        variable, request_year, month = (
+            request["variable"][0],
+            request["year"][0],
+            request["month"][0],
+        )
+        missing.setdefault(request_year, {}).setdefault(variable, {})[
+            month
+        ] = output_file
+
+    plan = []
+    for request_year, variable_files in missing.items():
+        # Variables that miss the same months can share a request. Variables with
+        # unknown names in the downloaded files cannot be split from others.
+        groups = {}
+        for variable, month_files in variable_files.items():
+            key = tuple(month_files)
+            if variable not in ERA5_SHORT_NAMES:
+                key += (variable,)
+            groups.setdefault(key, []).append(variable)
+
+        for group_key, variables in groups.items():
+            group_months = list(variable_files[variables[0]])
+            variables_per_request = max(
+                1, min(len(variables), max_items // ITEMS_PER_MONTH)
+            )
+            for request_variables in _chunks(variables, variables_per_request):
+                months_per_request = max(
+                    1, max_items // (ITEMS_PER_MONTH * len(request_variables))
+                )
+                for request_months in _chunks(group_months, months_per_request):
+                    plan.append(
+                        {
+                            "request": era5_request(
+                                request_variables, request_year, request_months, bbox
+                            ),
+                            "outputs": {
+                                (variable, month): variable_files[variable][month]
+                                for variable in request_variables
+                                for month in request_months
+                            },
+                        }
+                    )
+    return plan
+
+
+def split_download(filename: str, outputs: dict[tuple[str, str], str]) -> None:
+    """Split a merged download into the monthly file of each variable.
+
+    Args:
+        filename (str): Downloaded netCDF file, or zip archive of netCDF files
+        outputs (dict[tuple[str, str], str]): Monthly file of each (variable, month)
+
+    Raises:
+        ValueError: If the download has no data for some of the outputs. Downloading
+            the same request again would not help, so run_downloads does not retry it
+    """
+    requested = sorted({variable for variable, _ in outputs})
+    written = set()
+    with _NETCDF_LOCK, tempfile.TemporaryDirectory() as temp_folder:
+        # The CDS returns a zip archive when the variables come in several files
+        if zipfile.is_zipfile(filename):
+            with zipfile.ZipFile(filename) as archive:
+                archive.extractall(temp_folder)
+            members = [
+                os.path.join(temp_folder, member)
+                for member in sorted(os.listdir(temp_folder))
+                if member.endswith(".nc")
+            ]
+        else:
+            members = [filename]
+
+        for member in members:
+            with xr.open_dataset(member) as dataset:
+                time_dim = "valid_time" if "valid_time" in dataset.dims else "time"
+                file_months = dataset[time_dim].dt.month.values
+                for varname in dataset.data_vars:
+                    if len(requested) == 1:
+                        variable = requested[0]
+                    else:
+                        variable = next(
+                            (
+                                variable
+                                for variable in requested
+                                if varname in ERA5_SHORT_NAMES.get(variable, ())
+                            ),
+                            None,
+                        )
+                    if variable is None:
+                        continue
+                    for (output_variable, month), output_file in outputs.items():
+                        in_month = file_months == int(month)
+                        if output_variable != variable or not in_month.any():
+                            continue
+                        dataset[[varname]].isel({time_dim: in_month}).to_netcdf(
+                            f"{output_file}.tmp"
+                        )
+                        os.replace(f"{output_file}.tmp", output_file)
+                        written.add((output_variable, month))
+
+    missing = sorted(set(outputs) - written)
+    if missing:
+        raise ValueError(f"Download {filename} has no data for {missing}")
+
+
+def download_request(
+    plan_entry: dict, download_folder: str, client: cdsapi.Client | None = None
+) -> int:
+    """Download a merged request from plan_requests and split it into monthly files.
+
+    Args:
+        plan_entry (dict): Entry returned by plan_requests
+        download_folder (str): Path to save the downloaded files
+        client (cdsapi.Client, optional): Client to send the request. Defaults to None, which creates one
+
+    Returns:
+        int: Number of bytes downloaded
+    """
+    request = plan_entry["request"]
+    digest = hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+    target = f"{download_folder}/request_{digest[:16]}.download"
+
+    current_time = dt.now()
+    print(
+        f"Start downloading {len(request['variable'])} variables for months "
+        f"{','.join(request['month'])} of {request['year'][0]} at",
+        current_time.strftime("%H:%M:%S"),
+    )
+    if client is None:
+        client = cdsapi.Client()
+    try:
+        client.retrieve(ERA5_DATASET, request, target)
+        downloaded_bytes = os.path.getsize(target)
+        if not zipfile.is_zipfile(target) and not _is_readable(target):
+            raise IncompleteDownloadError(
+                f"Downloaded file is neither zip nor valid netCDF: {target}"
+            )
+        split_download(target, plan_entry["outputs"])
+    finally:
+        if os.path.exists(target):
+            os.remove(target)
+    for (variable, month), output_file in plan_entry["outputs"].items():
+        record_download(
+            output_file,
+            era5_request([variable], request["year"][0], [month], request["area"]),
+        )
 
     total_mins = round((dt.now() - current_time).seconds / 60, 2)
-    print(f"Completed downloading {era5_variable} for {month} in {total_mins} mins")
+    print(f"Completed downloading request {digest[:16]} in {total_mins} mins")
+    return downloaded_bytes
+
+
+def is_transient(error: Exception) -> bool:
+    """Return whether a failed download is worth retrying.
+
+    These are the TRANSIENT_ERRORS, and HTTP errors of the server (5xx) or of too
+    many requests (429).
+    """
+    if isinstance(error, requests.exceptions.HTTPError):
+        status = getattr(error.response, "status_code", None)
+        return status is not None and (status >= 500 or status == 429)
+    return isinstance(error, TRANSIENT_ERRORS)
+
+
+def run_downloads(
+    tasks: list[tuple[str, Callable, tuple]],
+    max_concurrent: int = MAX_CONCURRENT_REQUESTS,
+    max_retries: int = 3,
+    backoff: float = 30.0,
+    client_factory: Callable[[], cdsapi.Client] = cdsapi.Client,
+    sleep: Callable[[float], None] = time.sleep,
+) -> None:
+    """Run downloads with at most `max_concurrent` at a time, retrying transient failures.
+
+    Failures are retried if is_transient returns True. Other failures, e.g. a
+    missing permission or a full disk, are not.
+
+    Clients are reused across downloads and a client is dropped after a failure.
+    Failed downloads do not stop the others; they are reported once all downloads
+    have finished.
+
+    Args:
+        tasks (list[tuple[str, Callable, tuple]]): Label, function and arguments of each
+            download. The function is called with the extra keyword `client` and returns
+            the number of bytes downloaded
+        max_concurrent (int, optional): Maximum number of running downloads. Defaults to MAX_CONCURRENT_REQUESTS
+        max_retries (int, optional): Number of retries of a failed download. Defaults to 3
+        backoff (float, optional): Seconds before the first retry, doubled for every next
+            retry. Defaults to 30.0
+        client_factory (Callable[[], cdsapi.Client], optional): Creates a client. Defaults to cdsapi.Client
+        sleep (Callable[[float], None], optional): Waits the given seconds before a retry.
+            Defaults to time.sleep
+
+    """
+    clients = queue.SimpleQueue()
+
+    def run_task(label: str, function: Callable, args: tuple) -> int:
+        for attempt in range(max_retries + 1):
+            try:
+                client = clients.get_nowait()
+            except queue.Empty:
+                client = client_factory()
+            try:
+                downloaded_bytes = function(*args, client=client)
+            except Exception as error:
+                if attempt == max_retries or not is_transient(error):
+                    raise
+                delay = backoff * 2**attempt
+                print(f"{label} failed ({error}). Retrying in {delay:.0f} s")
+                sleep(delay)
+            else:
+                clients.put(client)
+                return downloaded_bytes
+
+    start_time = time.monotonic()
+    total_bytes = 0
+    failures = []
+    with concurrent.futures.ThreadPoolExecutor(max_concurrent) as executor:
+        futures = {executor.submit(run_task, *task): task[0] for task in tasks}
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            label = futures[future]
+            try:
+                total_bytes += future.result()
+                status = "done"
+            except Exception as error:
+                failures.append((label, error))
+                status = "failed"
+
+            elapsed = time.monotonic() - start_time
+            remaining = elapsed / done * (len(tasks) - done)
+            print(
+                f"[{done}/{len(tasks)}] {label} {status}. "
+                f"{total_bytes / 1e6:.1f} MB in {elapsed / 60:.1f} mins "
+                f"({total_bytes / 1e6 / max(elapsed, 1e-9):.2f} MB/s), "
+                f"about {remaining / 60:.1f} mins left"
+            )
+
+    if failures:
+        for label, error in failures:
+            print(f"Failed to download {label}: {error!r}")
+        raise RuntimeError(f"{len(failures)} of {len(tasks)} downloads failed")
+
+
+def download_files(
+    downloads: dict[str, dict],
+    download_folder: str,
+    parallel: bool = True,
+    merge_requests: bool = False,
+    client: cdsapi.Client | None = None,
+    max_concurrent: int = MAX_CONCURRENT_REQUESTS,
+    max_retries: int = 3,
+) -> None:
+    """Download the files of `downloads` that are missing or fail verification
+
+    Args:
+        downloads (dict[str, dict]): CDS request of each file, as returned by expected_downloads
+        download_folder (str): Path to save the downloaded files
+        parallel (bool, optional): Download data in parallel. Defaults to True
+        merge_requests (bool, optional): Merge variables and months into few large requests
+            with merge_downloads. Defaults to False
+        client (cdsapi.Client, optional): Client to send the requests. Defaults to None, which
+            creates a pool of clients
+        max_concurrent (int, optional): Maximum number of parallel downloads. Defaults to MAX_CONCURRENT_REQUESTS
+        max_retries (int, optional): Number of retries of a failed download. Defaults to 3
+
+    """
+    if merge_requests:
+        plan = merge_downloads(downloads, download_folder)
+        print(f"Merged the downloads into {len(plan)} requests.")
+        tasks = [
+            (
+                f"{len(entry['request']['variable'])} variables for months "
+                f"{','.join(entry['request']['month'])} of {entry['request']['year'][0]}",
+                download_request,
+                (entry, download_folder),
+            )
+            for entry in plan
+        ]
+
+    else:
+        missing = set(verify_downloads(downloads, download_folder))
+        # The checks of verify_downloads are reused instead of hashing the files again
+        tasks = [
+            (
+                os.path.basename(output_file),
+                functools.partial(download_data, check_existing=False),
+                (
+                    request["variable"][0],
+                    request["month"][0],
+                    request["year"][0],
+                    request["area"],
+                    output_file,
+                ),
+            )
+            for output_file, request in downloads.items()
+            if output_file in missing
+        ]
+
+    run_downloads(
+        tasks,
+        max_concurrent=max_concurrent if parallel else 1,
+        max_retries=max_retries,
+        client_factory=cdsapi.Client if client is None else lambda: client,
+    )
+    print("All downloads completed.")
 
 
 def get_era5(
@@ -118,6 +799,7 @@ def get_era5(
     bbox: list[float],
     download_folder: str,
     parallel: bool = True,
+    **kwargs,
 ) -> None:
     """Download ERA5 data for the specified variables, year, and bounding box
 
@@ -127,68 +809,145 @@ def get_era5(
         bbox (list[float]): Bounding box coordinates, ordering as max_y, min_x, min_y, max_x
         download_folder (str): Path to save the downloaded files
         parallel (bool, optional): Download data in parallel. Defaults to True
+        **kwargs: Other download options of download_files, e.g. merge_requests
 
     """
-    # Identify months to download -- including month -1 and month +1
-    months = [str(i).zfill(2) for i in range(1, 13)]
+    downloads = expected_downloads(era5_variables, year, bbox, download_folder)
+    download_files(downloads, download_folder, parallel=parallel, **kwargs)
 
-    # Input arguments for month -1 and month +1
-    month_00_args = [
-        (
-            variable,
-            "12",  # December of the previous year
-            str(int(year) - 1),
-            bbox,
-            f"{download_folder}/{era5_variables[variable]}_00.nc",
-        )
-        for variable in era5_variables
-    ]
-    month_13_args = [
-        (
-            variable,
-            "01",  # January of the next year
-            str(int(year) + 1),
-            bbox,
-            f"{download_folder}/{era5_variables[variable]}_13.nc",
-        )
-        for variable in era5_variables
-    ]
-    boundary_months = month_00_args + month_13_args
-
-    # Download data in parallel
-    if parallel:
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            # Package the arguments for the parallel download
-            args = [
-                (
-                    variable,
-                    month,
-                    year,
-                    bbox,
-                    f"{download_folder}/{era5_variables[variable]}_{month}.nc",
-                )
-                for variable in era5_variables
-                for month in months
-            ]
-            args.extend(boundary_months)
-            executor.map(download_data, *zip(*args))
 
-    # Download data sequentially
-    else:
-        for variable in era5_variables:
-            for month in months:
-                download_data(
-                    variable,
-                    month,
-                    year,
-                    bbox,
-                    f"{download_folder}/{era5_variables[variable]}_{month}.nc",
-                )
-        # Month -1 and month +1 for each variable
-        for args in boundary_months:
-            download_data(*args)
+def get_era5_years(
+    era5_variables: dict[str, str],
+    start_year: str,
+    end_year: str,
+    bbox: list[float],
+    cache_folder: str,
+    **kwargs,
+) -> None:
+    """Download ERA5 data for several years into a shared cache of monthly files
+
+    Months already in the cache are not downloaded again, so consecutive or
+    overlapping runs only add the months they are missing. The extraction
+    scripts read any period from the cache.
+
+    Args:
+        era5_variables (dict[str, str]): Dictionary of ERA5 variables for the target renewable energy source
+        start_year (str): First year, e.g. '2019'
+        end_year (str): Last year (inclusive), e.g. '2023'
+        bbox (list[float]): Bounding box coordinates, ordering as max_y, min_x, min_y, max_x
+        cache_folder (str): Path of the cache
+        **kwargs: Download options of download_files, e.g. parallel or merge_requests
+
+    """
+    downloads = cached_downloads(
+        era5_variables, start_year, end_year, bbox, cache_folder
+    )
+    download_files(downloads, cache_folder, **kwargs)
 
-    print("All downloads completed.")
+
+def get_era5_boxes(
+    era5_variables: dict[str, str],
+    year: str,
+    bboxes: list[tuple[float, float, float, float]],
+    download_folder: str,
+    **kwargs,
+) -> None:
+    """Download ERA5 data for several bounding boxes into the subfolders 'box_0', 'box_1', ...
+
+    extract_solar.create_weather_batch reads the boxes as one dataset, taking each
+    site from the box that covers it.
+
+    Args:
+        era5_variables (dict[str, str]): Dictionary of ERA5 variables for the target renewable energy source
+        year (str): Year to download, e.g. '2019'
+        bboxes (list[tuple[float, float, float, float]]): Boxes returned by get_bboxes
+        download_folder (str): Path to save the downloaded files
+        **kwargs: Other arguments of get_era5
+    """
+
+    # Compare the downloaded grid cells with those of one box around all sites
+    def n_cells(bbox):
+        max_y, min_x, min_y, max_x = bbox
+        return (round((max_y - min_y) / 0.25) + 1) * (round((max_x - min_x) / 0.25) + 1)
+
+    max_ys, min_xs, min_ys, max_xs = zip(*bboxes)
+    union = (max(max_ys), min(min_xs), min(min_ys), max(max_xs))
+    print(
+        f"Downloading {sum(n_cells(bbox) for bbox in bboxes)} grid cells in "
+        f"{len(bboxes)} boxes instead of {n_cells(union)} in one box."
+    )
+
+    for position, bbox in enumerate(bboxes):
+        box_folder = f"{download_folder}/box_{position}"
+        os.makedirs(box_folder, exist_ok=True)
+        get_era5(era5_variables, year, bbox, box_folder, **kwargs)
+
+
+def rechunk_data(
+    era5_variables: dict[str, str], download_folder: str, complevel: int = 4
+) -> None:
+    """Merge the monthly files of each variable into one compressed NetCDF file
+    chunked along time per grid cell.
+
+    The downloaded files are chunked spatially, so reading the full timeseries of
+    one site touches every monthly file. After merging, the timeseries of a grid
+    cell is a single contiguous chunk. The merged file is named after the variable,
+    e.g. '2m_temperature.nc', and is used by extract_solar.create_weather_batch
+    when it exists and matches the monthly files. A merged file is made again when
+    a monthly file changed since it was merged.
+
+    Args:
+        era5_variables (dict[str, str]): Dictionary of ERA5 variables for the target renewable energy source
+        download_folder (str): Path of the downloaded files
+        complevel (int, optional): zlib compression level. Defaults to 4
+
+    """
+    # Month -1 (00) and month +1 (13) are included as in get_era5
+    months = [str(i).zfill(2) for i in range(0, 14)]
+
+    for name in era5_variables.values():
+        output_file = f"{download_folder}/{name}.nc"
+        monthly_files = [f"{download_folder}/{name}_{month}.nc" for month in months]
+        if os.path.exists(output_file):
+            with xr.open_dataset(output_file) as dataset:
+                inputs = json.loads(dataset.attrs.get(INPUTS_ATTRIBUTE, "{}"))
+            if inputs_match(inputs, monthly_files):
+                print(f"File already exists: {output_file}. Skipping rechunk.")
+                continue
+            print(f"Monthly files of {name} changed. Rechunking {output_file} again.")
+
+        # Recorded before reading, so a file replaced meanwhile is merged again next time
+        inputs = era5_inputs(monthly_files)
+        monthly = [xr.open_dataset(filename) for filename in monthly_files]
+        try:
+            # Older files use "time" while newer CDS files use "valid_time"
+            time_dim = "valid_time" if "valid_time" in monthly[0].dims else "time"
+            merged = xr.concat(monthly, dim=time_dim)
+            merged.attrs[INPUTS_ATTRIBUTE] = json.dumps(inputs, sort_keys=True)
+
+            encoding = {}
+            for varname, variable in merged.data_vars.items():
+                if set(variable.dims) != {time_dim, "latitude", "longitude"}:
+                    continue
+                merged[varname] = variable.transpose(time_dim, "latitude", "longitude")
+                # Drop the chunking and packing of the downloaded files
+                merged[varname].encoding = {}
+                encoding[varname] = {
+                    "zlib": True,
+                    "complevel": complevel,
+                    "chunksizes": (merged.sizes[time_dim], 1, 1),
+                }
+            try:
+                merged.to_netcdf(f"{output_file}.tmp", encoding=encoding)
+                os.replace(f"{output_file}.tmp", output_file)
+            except BaseException:
+                if os.path.exists(f"{output_file}.tmp"):
+                    os.remove(f"{output_file}.tmp")
+                raise
+        finally:
+            for dataset in monthly:
+                dataset.close()
+        print(f"Rechunked {name} into {output_file}")
 
 
 if __name__ == "__main__":
@@ -198,7 +957,10 @@ if __name__ == "__main__":
 
     location_df = pd.read_csv("nondispatch_spp.csv")
 
-    bbox = get_bbox(location_df[location_df["spp_fuel"] == renewable_type])
+    # Download one box around each cluster of sites instead of one box around all sites
+    multi_bbox = False
+    # Download several years into a shared monthly cache instead, e.g. ("2019", "2023")
+    years = None
 
     download_folder = f"./{renewable_type}_data"
     if not os.path.exists(download_folder):
@@ -207,4 +969,20 @@ if __name__ == "__main__":
     # Parameters to download from ERA5 for the renewable type
     era5_variables = get_variables(renewable_type)
 
-    get_era5(era5_variables, year, bbox, download_folder)
+    sites = location_df[location_df["spp_fuel"] == renewable_type]
+    if years is not None:
+        get_era5_years(era5_variables, *years, get_bbox(sites), download_folder)
+        # The extraction scripts read the period they need from the monthly files
+        box_folders = []
+    elif multi_bbox:
+        bboxes = get_bboxes(sites)
+        get_era5_boxes(era5_variables, year, bboxes, download_folder)
+        box_folders = [f"{download_folder}/box_{i}" for i in range(len(bboxes))]
+    else:
+        bbox = get_bbox(sites)
+        get_era5(era5_variables, year, bbox, download_folder)
+        box_folders = [download_folder]
+
+    # Merge the monthly files for fast per-site reads
+    for box_folder in box_folders:
+        rechunk_data(era5_variables, box_folder)
@@ -1,16 +1,77 @@
 import geopandas as gpd
 import numpy as np
 import pandas as pd
+import shapely
 from scipy.spatial import cKDTree
 
 
+def point_coords(points) -> np.ndarray:
+    """Return the (x, y) coordinates of point geometries as an (n x 2) array.
+
+    Args:
+        points: A GeoSeries, or a Series or array of shapely Points
+
+    Returns:
+        np.ndarray: The coordinates of each point, in the same order
+    """
+    geometries = np.asarray(points, dtype=object)
+    return np.column_stack([shapely.get_x(geometries), shapely.get_y(geometries)])
+
+
+class BusIndex:
+    """Spatial index of bus locations for nearest-neighbour queries.
+
+    The coordinates are read in bulk and the cKDTree is built once, so one index
+    answers every query on the same buses instead of a new tree per query.
+
+    Args:
+        buses (gpd.GeoDataFrame): The buses, with an 'id' column
+        geometry_col (str, optional): The column of the bus locations. Defaults to "geometry"
+
+    Example:
+        >>> index = BusIndex(clustered_buses)
+        >>> distances, positions = index.nearest(lines["source"])
+        >>> print(index.ids[positions])
+    """
+
+    def __init__(self, buses: gpd.GeoDataFrame, geometry_col: str = "geometry"):
+        self.coords = point_coords(buses[geometry_col])
+        self.ids = buses["id"].to_numpy()
+        self.tree = cKDTree(self.coords)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def nearest(self, points, k: int = 1) -> tuple[np.ndarray, np.ndarray]:
+        """Find the `k` nearest buses of each point.
+
+        Args:
+            points: Query points, as geometries or an (n x 2) array of coordinates
+            k (int, optional): Number of neighbours. Defaults to 1
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The distances and positions (in the index) of the
+                nearest buses, with shape (n,) if `k` is 1 and (n, k) otherwise. Missing
+                neighbours have an infinite distance and the position len(index)
+        """
+        return self.tree.query(_query_coords(points), k=k)
+
+
+def _query_coords(points) -> np.ndarray:
+    """Return query points as an (n x 2) array of coordinates"""
+    points = np.asarray(points)
+    if points.dtype == object:
+        return point_coords(points)
+    return points.reshape(-1, 2).astype(float)
+
+
 def ckdnearest(
     gdf_A: gpd.GeoDataFrame, gdf_B: gpd.GeoDataFrame, loc_col_A: str, loc_col_B: str
 ) -> tuple[pd.Series, pd.Series]:
-    """Finds the nearest point in `gdf_B` for each point in `gdf_A` using a cKDTree.
+    """Finds the nearest point in `gdf_B` for each point in `gdf_A` using a BusIndex.
 
-    This function efficiently computes the nearest neighbor between two GeoDataFrames
-    using a cKDTree for optimized spatial searching.
+    This function builds a BusIndex of `gdf_B` for a single query. Callers with
+    several queries on the same points should build the BusIndex once instead.
 
     Source: https://gis.stackexchange.com/questions/222315/finding-nearest-point-in-other-geodataframe-using-geopandas
 
@@ -30,12 +91,9 @@ def ckdnearest(
         >>> print(distances.head())
         >>> print(nearest_points.head())
     """
-
-    array_A = np.array(list(gdf_A[loc_col_A].apply(lambda x: (x.x, x.y))))
-    array_B = np.array(list(gdf_B[loc_col_B].apply(lambda x: (x.x, x.y))))
-    btree = cKDTree(array_B)
-    dist, idx = btree.query(array_A, k=1)
-    gdf_B_nearest = gdf_B.id.iloc[idx].drop(columns=loc_col_B).reset_index(drop=True)
+    index = BusIndex(gdf_B, geometry_col=loc_col_B)
+    dist, idx = index.nearest(gdf_A[loc_col_A])
+    gdf_B_nearest = pd.Series(index.ids[idx], name="id")
     dist = pd.Series(dist, name="dist")
     return dist, gdf_B_nearest
 
@@ -44,7 +44,7 @@ def main():
     bus_cluster_distance = 500  # Distance threshold for clustering buses
     overpass_distance = 300  # Distance threshold for overpassing lines
     isolated_bus_distance = 1000  # Distance threshold for isolated buses
-    max_subgraph_iter = 50  # Number of iterations to connect disconnected subgraphs
+    workers = 1  # Number of processes used to split overpassing lines
 
     country = "THA"  # Country code
 
@@ -106,7 +106,7 @@ def main():
     buses = pd.concat([buses, line_buses], axis=0, ignore_index=True)
     clustered_buses = cluster_buses(buses, cluster_distance=bus_cluster_distance)
     lines = split_overpassing_lines(
-        lines, clustered_buses, filter_distance=overpass_distance
+        lines, clustered_buses, filter_distance=overpass_distance, workers=workers
     )
     lines = extend_line_to_bus(lines, clustered_buses)
 
@@ -121,24 +121,8 @@ def main():
     lines = pd.concat([lines, fake_line_gdf], axis=0, ignore_index=True)
 
     # Connect disconnected subgraphs
-    subgraph_lines = []
-    for c_idx in range(max_subgraph_iter):
-        connected_subgraph_lines = connect_subgraphs(lines, clustered_buses, c_idx)
-        if not connected_subgraph_lines:
-            break
-        subgraph_lines.extend(connected_subgraph_lines)
-        connected_subgraph_lines = gpd.GeoDataFrame(
-            connected_subgraph_lines,
-            geometry="geometry",
-            crs=lines.crs,
-        )
-        lines = pd.concat([lines, connected_subgraph_lines], axis=0, ignore_index=True)
-        if c_idx == max_subgraph_iter:
-            raise ValueError("Reached maximum number of iterations.")
-
-    subgraph_lines = gpd.GeoDataFrame(
-        subgraph_lines, geometry="geometry", crs=lines.crs
-    )
+    subgraph_lines = connect_subgraphs(lines, clustered_buses)
+    lines = pd.concat([lines, subgraph_lines], axis=0, ignore_index=True)
 
     # Drop isolated buses that are not overpassing lines
     # but also not within the isolated_bus_distance
@@ -0,0 +1,326 @@
+""" Offline tests of the downloads of get_era5.py.
+
+FakeClient stands in for cdsapi.Client. It answers a request with hourly data
+of the requested variables and months, as one netCDF file or, like the CDS for
+several variables, as a zip archive with one netCDF file per variable.
+
+Run with pytest from this folder.
+
+"""
+
+import errno
+import os
+import zipfile
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+import pytest
+import requests
+import xarray as xr
+
+import get_era5
+
+BBOX = [14.0, 100.0, 13.5, 100.5]  # North, West, South, East
+
+
+def fake_dataset(variable: str, request: dict) -> xr.Dataset:
+    """Return the hours of a variable in the months of a request, valued by their month"""
+    times = pd.DatetimeIndex(
+        [
+            time
+            for month in request["month"]
+            for time in pd.date_range(
+                f"{request['year'][0]}-{month}-01", periods=31 * 24, freq="h"
+            )
+            if time.month == int(month)
+        ]
+    )
+    north, west, south, east = request["area"]
+    latitudes = np.arange(north, south - 0.125, -0.25)
+    longitudes = np.arange(west, east + 0.125, 0.25)
+    values = np.broadcast_to(
+        times.month.values[:, None, None].astype(np.float32),
+        (len(times), len(latitudes), len(longitudes)),
+    )
+    return xr.Dataset(
+        {
+            get_era5.ERA5_SHORT_NAMES[variable][0]: (
+                ("valid_time", "latitude", "longitude"),
+                values,
+            )
+        },
+        coords={"valid_time": times, "latitude": latitudes, "longitude": longitudes},
+    )
+
+
+class FakeClient:
+    """Stand-in for cdsapi.Client that writes synthetic ERA5 data.
+
+    Args:
+        zip_response (bool, optional): Answer requests of several variables with a zip
+            archive of one file per variable. Defaults to True
+        drop (tuple[str], optional): Variables left out of the responses. Defaults to ()
+        failures (list[Exception], optional): Errors raised by the next retrievals, in order.
+            Clients may share the list to fail across a client pool. Defaults to None
+    """
+
+    def __init__(
+        self,
+        zip_response: bool = True,
+        drop: tuple[str] = (),
+        failures: list[Exception] | None = None,
+    ):
+        self.zip_response = zip_response
+        self.drop = drop
+        self.failures = [] if failures is None else failures
+        self.requests = []
+
+    def retrieve(self, name: str, request: dict, target: str) -> None:
+        self.requests.append(request)
+        if self.failures:
+            raise self.failures.pop(0)
+        datasets = [
+            fake_dataset(variable, request)
+            for variable in request["variable"]
+            if variable not in self.drop
+        ]
+        # Downloads run in threads and the netCDF library is not thread-safe
+        with get_era5._NETCDF_LOCK:
+            if not self.zip_response or len(request["variable"]) == 1:
+                xr.merge(datasets).to_netcdf(target)
+                return
+            with zipfile.ZipFile(target, "w") as archive:
+                for position, dataset in enumerate(datasets):
+                    member = f"{target}.{position}.nc"
+                    dataset.to_netcdf(member)
+                    archive.write(member, f"data_stream-{position}.nc")
+                    os.remove(member)
+
+
+def request_items(request: dict) -> int:
+    """Return the number of items of a CDS request as counted by merge_downloads"""
+    return len(request["variable"]) * len(request["month"]) * get_era5.ITEMS_PER_MONTH
+
+
+def check_monthly_files(downloads: dict[str, dict], download_folder: str) -> None:
+    """Check that each monthly file has only its variable and month, and matches the manifest"""
+    manifest = get_era5.load_manifest(download_folder)
+    for filename, request in downloads.items():
+        variable, month = request["variable"][0], request["month"][0]
+        with xr.open_dataset(filename) as dataset:
+            assert list(dataset.data_vars) == [get_era5.ERA5_SHORT_NAMES[variable][0]]
+            times = pd.DatetimeIndex(dataset["valid_time"].values)
+            assert (times.month == int(month)).all()
+            assert (times.year == int(request["year"][0])).all()
+            assert len(times) == times.days_in_month[0] * 24
+        assert get_era5.check_download(filename, request, manifest)
+    assert get_era5.verify_downloads(downloads, download_folder) == []
+
+
+def test_plan_respects_item_limit(tmp_path):
+    era5_variables = get_era5.get_variables("wind")
+    downloads = get_era5.expected_downloads(era5_variables, "2023", BBOX, tmp_path)
+    plan = get_era5.plan_requests(era5_variables, "2023", BBOX, tmp_path)
+
+    # 12 months of 7 variables exceed one request, the edge months are other years
+    assert len(plan) == 4
+    assert all(
+        request_items(entry["request"]) <= get_era5.MAX_REQUEST_ITEMS for entry in plan
+    )
+    outputs = [output for entry in plan for output in entry["outputs"].values()]
+    assert sorted(outputs) == sorted(downloads)
+    for entry in plan:
+        for (variable, month), output in entry["outputs"].items():
+            assert downloads[output]["variable"] == [variable]
+            assert downloads[output]["month"] == [month]
+            assert downloads[output]["year"] == entry["request"]["year"]
+
+
+def test_plan_splits_variables_over_small_limit(tmp_path):
+    downloads = get_era5.expected_downloads(
+        get_era5.get_variables("solar"), "2023", BBOX, tmp_path
+    )
+    max_items = 2 * get_era5.ITEMS_PER_MONTH
+    plan = get_era5.merge_downloads(downloads, tmp_path, max_items)
+
+    assert all(request_items(entry["request"]) <= max_items for entry in plan)
+    outputs = [output for entry in plan for output in entry["outputs"].values()]
+    assert sorted(outputs) == sorted(downloads)
+
+
+@pytest.mark.parametrize("zip_response", [True, False])
+def test_merged_download_writes_monthly_files(tmp_path, zip_response):
+    era5_variables = get_era5.get_variables("solar")
+    downloads = get_era5.expected_downloads(era5_variables, "2023", BBOX, tmp_path)
+    client = FakeClient(zip_response=zip_response)
+    get_era5.download_files(downloads, tmp_path, merge_requests=True, client=client)
+
+    assert len(client.requests) == len(
+        get_era5.plan_requests(era5_variables, "2023", BBOX, tmp_path / "empty")
+    )
+    check_monthly_files(downloads, tmp_path)
+    assert not any(name.endswith(".download") for name in os.listdir(tmp_path))
+    # Complete files are not requested again
+    assert get_era5.plan_requests(era5_variables, "2023", BBOX, tmp_path) == []
+
+
+def test_merged_download_replaces_changed_file(tmp_path):
+    era5_variables = get_era5.get_variables("solar")
+    downloads = get_era5.expected_downloads(era5_variables, "2023", BBOX, tmp_path)
+    get_era5.download_files(
+        downloads, tmp_path, merge_requests=True, client=FakeClient()
+    )
+    changed = f"{tmp_path}/direct_shortwave_05.nc"
+    with open(changed, "ab") as file:
+        file.write(b"0")
+
+    plan = get_era5.plan_requests(era5_variables, "2023", BBOX, tmp_path)
+    assert [entry["outputs"] for entry in plan] == [
+        {("mean_surface_direct_short_wave_radiation_flux", "05"): changed}
+    ]
+    get_era5.download_files(
+        downloads, tmp_path, merge_requests=True, client=FakeClient()
+    )
+    check_monthly_files(downloads, tmp_path)
+
+
+def test_missing_variable_fails_without_retry(tmp_path):
+    era5_variables = get_era5.get_variables("solar")
+    downloads = get_era5.expected_downloads(era5_variables, "2023", BBOX, tmp_path)
+    client = FakeClient(drop=("2m_temperature",))
+    with pytest.raises(RuntimeError, match="downloads failed"):
+        get_era5.download_files(downloads, tmp_path, merge_requests=True, client=client)
+
+    # Each request is sent once and the download is removed
+    assert len(client.requests) == 3
+    assert not any(name.endswith(".download") for name in os.listdir(tmp_path))
+    manifest = get_era5.load_manifest(tmp_path)
+    assert not any(name.startswith("2m_temperature") for name in manifest)
+
+
+def http_error(status: int) -> requests.exceptions.HTTPError:
+    """Return the error raised by requests for an HTTP status"""
+    response = requests.Response()
+    response.status_code = status
+    return requests.exceptions.HTTPError(f"{status} error", response=response)
+
+
+def download_task(download_folder: str, month: str) -> tuple[str, Callable, tuple]:
+    """Return a run_downloads task of download_data for a month of 2m temperature"""
+    output_file = f"{download_folder}/2m_temperature_{month}.nc"
+    return (
+        os.path.basename(output_file),
+        get_era5.download_data,
+        ("2m_temperature", month, "2023", BBOX, output_file),
+    )
+
+
+def fake_client_factory(failures: list[Exception]) -> tuple[list[FakeClient], Callable]:
+    """Return the created clients and a factory of clients sharing `failures`"""
+    clients = []
+
+    def create_client() -> FakeClient:
+        clients.append(FakeClient(failures=failures))
+        return clients[-1]
+
+    return clients, create_client
+
+
+@pytest.mark.parametrize(
+    "failures",
+    [
+        [requests.exceptions.ConnectionError("reset")],
+        [requests.exceptions.Timeout("timeout"), http_error(503)],
+        [ConnectionResetError("reset"), http_error(429), TimeoutError("timeout")],
+    ],
+)
+def test_transient_errors_are_retried_with_backoff(tmp_path, failures):
+    n_failures = len(failures)
+    clients, create_client = fake_client_factory(failures)
+    delays = []
+    get_era5.run_downloads(
+        [download_task(tmp_path, "01")],
+        backoff=1.0,
+        client_factory=create_client,
+        sleep=delays.append,
+    )
+
+    assert delays == [2.0**attempt for attempt in range(n_failures)]
+    # A client is dropped after each failure
+    assert len(clients) == n_failures + 1
+    assert os.path.exists(f"{tmp_path}/2m_temperature_01.nc")
+
+
+def test_broken_file_is_retried(tmp_path, monkeypatch):
+    broken = []
+    fake_retrieve = FakeClient.retrieve
+
+    # The first download is cut short
+    def retrieve(self, name, request, target):
+        if not broken:
+            broken.append(target)
+            with open(target, "wb") as file:
+                file.write(b"CDF")
+            return
+        return fake_retrieve(self, name, request, target)
+
+    monkeypatch.setattr(FakeClient, "retrieve", retrieve)
+    delays = []
+    get_era5.run_downloads(
+        [download_task(tmp_path, "01")], client_factory=FakeClient, sleep=delays.append
+    )
+    assert delays == [30.0]
+    check_monthly_files(
+        {
+            f"{tmp_path}/2m_temperature_01.nc": get_era5.era5_request(
+                ["2m_temperature"], "2023", ["01"], BBOX
+            )
+        },
+        tmp_path,
+    )
+
+
+def test_failures_are_reported_after_other_downloads(tmp_path, capsys):
+    # One failure more than the retries, all taken by the first download
+    failures = [requests.exceptions.ConnectionError("reset")] * 4
+    _, create_client = fake_client_factory(failures)
+    delays = []
+    with pytest.raises(RuntimeError, match="1 of 2 downloads failed"):
+        get_era5.run_downloads(
+            [download_task(tmp_path, "01"), download_task(tmp_path, "02")],
+            max_concurrent=1,
+            max_retries=3,
+            backoff=1.0,
+            client_factory=create_client,
+            sleep=delays.append,
+        )
+
+    assert delays == [1.0, 2.0, 4.0]
+    assert not os.path.exists(f"{tmp_path}/2m_temperature_01.nc")
+    assert os.path.exists(f"{tmp_path}/2m_temperature_02.nc")
+    assert "Failed to download 2m_temperature_01.nc" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        PermissionError(errno.EACCES, "Permission denied"),
+        FileNotFoundError(errno.ENOENT, "No such file or directory"),
+        OSError(errno.ENOSPC, "No space left on device"),
+        http_error(404),
+        ValueError("invalid request"),
+    ],
+)
+def test_permanent_errors_are_not_retried(tmp_path, error):
+    clients, create_client = fake_client_factory([error])
+    delays = []
+    with pytest.raises(RuntimeError, match="1 of 1 downloads failed"):
+        get_era5.run_downloads(
+            [download_task(tmp_path, "01")],
+            client_factory=create_client,
+            sleep=delays.append,
+        )
+
+    assert delays == []
+    assert len(clients) == 1